@@ -0,0 +1,96 @@
+import array
+
+from draws import mix64
+
+
+# Level is the rank of question difficulty within the topic, 0 is the easiest
+START_LEVEL = 0.5
+# The next question is drawn from this many unasked ones closest to the level
+WINDOW = 3
+# The quiz stops early once the level has stayed within the tolerance for
+# this many answers (and at least min questions have been answered)
+STABLE_ANSWERS = 4
+MIN_QUESTIONS = 5
+
+
+def next_level(level: float, correct: bool, answered: int) -> float:
+    '''Return the level after answered-th (1-based) answer: higher after a
+    correct answer, lower otherwise, by steps shrinking as 1/answered
+    (Robbins-Monro), so it settles where the user answers about half of
+    the questions correctly
+    '''
+    step = 0.5 / (answered + 1)
+    return min(1.0, max(0.0, level + (step if correct else -step)))
+
+
+def settled(recent, answered: int, tolerance: float = None, min_questions: int = MIN_QUESTIONS) -> bool:
+    '''Return whether the quiz may stop: the last STABLE_ANSWERS levels
+    (recent) differ by tolerance at most, so further answers would barely
+    change the estimate. tolerance=None never stops early
+    '''
+    if tolerance is None or answered < min_questions or len(recent) < STABLE_ANSWERS:
+        return False
+    recent = recent[-STABLE_ANSWERS:]
+    return max(recent) - min(recent) <= tolerance
+
+
+def accuracy(question_stats) -> float:
+    '''Estimated chance of a correct answer, 0.5 for unanswered questions
+    (Laplace's rule of succession)
+    '''
+    if not question_stats:
+        return 0.5
+    return (question_stats['correct'] + 1) / (question_stats['n'] + 2)
+
+
+class DifficultyIndex:
+    '''Questions of adaptive topics ordered from the easiest to the hardest
+    by their statistics (ResultLog.stats, which is kept up to date as
+    answers come), per snapshot
+    The order is only rebuilt by refresh() (on startup and /reload), picking
+    a question does not touch the statistics
+    '''
+
+    def __init__(self):
+        self.orders = {}
+
+    def refresh(self, snapshots, stats: dict):
+        '''Rebuild orders of adaptive topics of snapshots'''
+        orders = {}
+        for snapshot in snapshots:
+            for topic_code, topic in snapshot.topics.items():
+                if topic['adaptive']:
+                    orders[snapshot.version, topic_code] = self.build(snapshot, topic, stats)
+        self.orders = orders
+
+    @staticmethod
+    def build(snapshot, topic: dict, stats: dict):
+        estimates = {index: accuracy(stats.get(snapshot.load_uncached(index).key)) for index in topic['q_indices']}
+        return array.array('I', sorted(estimates, key=lambda index: (-estimates[index], index)))
+
+    def order(self, snapshot, topic_code: str):
+        order = self.orders.get((snapshot.version, topic_code))
+        if order is None:
+            # Not refreshed since the snapshot was loaded, file order for now
+            order = self.orders[snapshot.version, topic_code] = snapshot.topics[topic_code]['q_indices']
+        return order
+
+    def pick(self, snapshot, topic_code: str, level: float, asked, seed: int, q_id: int) -> int:
+        '''Return index (within snapshot questions) of an unasked question
+        of about level difficulty, one of WINDOW closest chosen by seed
+        '''
+        order = self.order(snapshot, topic_code)
+        asked = set(asked)
+        rank = round(level * (len(order) - 1))
+        lower, upper = rank - 1, rank
+        window = []
+        while len(window) < WINDOW and (lower >= 0 or upper < len(order)):
+            if upper < len(order):
+                if order[upper] not in asked:
+                    window.append(order[upper])
+                upper += 1
+            if lower >= 0 and len(window) < WINDOW:
+                if order[lower] not in asked:
+                    window.append(order[lower])
+                lower -= 1
+        return window[mix64(seed ^ q_id) % len(window)]
@@ -0,0 +1,346 @@
+import asyncio
+import collections
+import contextlib
+import time
+
+from aiogram import types
+from aiogram.utils import exceptions
+
+from quizes import MESSAGE_LIMIT, utf16_length
+
+
+PAGE_SIZE = 10
+# User info and Telegram info are cut to this many characters on the dashboard
+INFO_LENGTH = 100
+# Room left for the page number
+PAGES_LENGTH = 20
+# Waiting users as found in the storage
+PendingUser = collections.namedtuple('PendingUser', 'user_id topic_code user_info tg_info since admin')
+
+
+class Dashboard:
+    '''Self-updating message in an admin chat listing users waiting for
+    admission
+
+    The page, selected users, message id and the number of users shown are
+    kept in the admin's data in storage (see get_state()), so that every bot
+    process sharing the storage handles the dashboard the same way.
+    on_change() coroutine is awaited after the data is changed
+
+    render(chat_id, page, selected) coroutine returns (text, keyboard, page
+    actually shown, pending_count), send(chat_id, text, keyboard) and
+    edit(chat_id, message_id, text, keyboard) coroutines deliver it. A new
+    message is sent (so the admin is notified) when somebody starts waiting
+    while nobody was, otherwise the existing message is edited. Replaced
+    messages are deleted by cleaner (MessageCleaner)
+    '''
+
+    def __init__(self, chat_id, render, send, edit, cleaner, storage, on_change, delay: float = 1.0):
+        self.chat_id = chat_id
+        self.render = render
+        self.send = send
+        self.edit = edit
+        self.cleaner = cleaner
+        self.storage = storage
+        self.on_change = on_change
+        self.delay = delay
+        self._timer = None
+
+    async def get_state(self) -> dict:
+        '''Return {'page', 'selected' (set), 'message', 'pending'}'''
+        data = await self.storage.get_data(chat=self.chat_id, user=self.chat_id)
+        state = data.get('dashboard', {})
+        return {
+            'page': state.get('page', 0),
+            'selected': set(state.get('selected', ())),
+            'message': state.get('message'),
+            'pending': state.get('pending', 0),
+        }
+
+    async def set_state(self, state: dict):
+        state = dict(state, selected=sorted(state['selected']))
+        await self.storage.update_data(chat=self.chat_id, user=self.chat_id, data={'dashboard': state})
+        await self.on_change()
+
+    def lock(self, current_chat_id=None):
+        '''Return storage lock of the admin chat, or a dummy one if it is
+        current_chat_id (the chat of the update being handled, already locked)
+        '''
+        if str(self.chat_id) == str(current_chat_id):
+            return contextlib.nullcontext()
+        return self.storage.lock(self.chat_id)
+
+    def request_refresh(self):
+        '''Refresh in delay seconds, coalescing requests made meanwhile'''
+        if self._timer is None:
+            self._timer = asyncio.ensure_future(self._refresh_later())
+
+    async def _refresh_later(self):
+        await asyncio.sleep(self.delay)
+        self._timer = None
+        try:
+            await self.refresh()
+        except Exception as e:
+            print(f'Oops, admission dashboard refresh failed: {e!r}')
+
+    async def refresh(self, new_message: bool = False, current_chat_id=None):
+        '''Show the current state, in a new message if new_message is set'''
+        async with self.lock(current_chat_id):
+            state = await self.get_state()
+            text, keyboard, state['page'], pending_count = await self.render(self.chat_id, state['page'], state['selected'])
+            new_message = new_message or (pending_count and not state['pending'])
+            state['pending'] = pending_count
+            if state['message'] is not None and not new_message:
+                try:
+                    await self.edit(self.chat_id, state['message'], text, keyboard)
+                except exceptions.MessageNotModified:
+                    pass
+                except exceptions.TelegramAPIError:
+                    # Deleted by the admin or too old to be edited
+                    new_message = True
+            if state['message'] is None or new_message:
+                message = await self.send(self.chat_id, text, keyboard)
+                if state['message'] is not None:
+                    self.cleaner.schedule(self.chat_id, [state['message']])
+                state['message'] = message.message_id
+            await self.set_state(state)
+
+
+class Digest:
+    '''Collect notifications for a chat and send them together every delay
+    seconds, as few messages (of up to MESSAGE_LIMIT characters) as possible,
+    retrying the ones which failed to be sent
+    send(chat_id, text) coroutine delivers a message
+    '''
+
+    def __init__(self, chat_id, send, delay: float = 5.0):
+        self.chat_id = chat_id
+        self.send = send
+        self.delay = delay
+        self._items = []
+        self._timer = None
+
+    def add(self, text: str):
+        self._items.append(clip(text, MESSAGE_LIMIT))
+        self._schedule()
+
+    def _schedule(self):
+        if self._timer is None:
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.delay)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f'Oops, admin digest was not sent: {e!r}')
+            if self._items:
+                self._schedule()
+
+    async def flush(self):
+        '''Send collected items, the ones which failed to be sent are kept
+        for the next flush (unless the chat can not be written to at all)
+        '''
+        items, self._items = self._items, []
+        while items:
+            chunk, count = items[0], 1
+            while count < len(items) and utf16_length(chunk) + 2 + utf16_length(items[count]) <= MESSAGE_LIMIT:
+                chunk = f'{chunk}\n\n{items[count]}'
+                count += 1
+            try:
+                await self.send(self.chat_id, chunk)
+            except (exceptions.Unauthorized, exceptions.BadRequest):
+                raise
+            except Exception:
+                self._items[:0] = items
+                raise
+            del items[:count]
+
+    async def close(self):
+        '''Send what is collected, call on shutdown'''
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f'Oops, admin digest was not sent: {e!r}')
+
+
+class PendingIndex:
+    '''Users waiting for admission (PendingUser), per admin, kept up to date
+    as requests come and go, so that routing and dashboards do not scan the
+    storage
+
+    The index is filled from a storage scan by replace(); changes made while
+    the scan is in progress (see begin_rebuild()) are applied on top of it
+    '''
+
+    def __init__(self):
+        self.users = {}
+        self.by_admin = collections.defaultdict(dict)
+        self._changes = None
+
+    def __len__(self):
+        return len(self.users)
+
+    def add(self, pending_user: PendingUser):
+        self._forget(pending_user.user_id)
+        self.users[pending_user.user_id] = pending_user
+        self.by_admin[pending_user.admin][pending_user.user_id] = pending_user
+        if self._changes is not None:
+            self._changes[pending_user.user_id] = pending_user
+
+    def discard(self, user_id: int):
+        self._forget(user_id)
+        if self._changes is not None:
+            self._changes[user_id] = None
+
+    def _forget(self, user_id: int):
+        pending_user = self.users.pop(user_id, None)
+        if pending_user is not None:
+            waiting = self.by_admin[pending_user.admin]
+            del waiting[user_id]
+            if not waiting:
+                del self.by_admin[pending_user.admin]
+
+    def begin_rebuild(self):
+        '''Start recording changes, call before scanning the storage'''
+        self._changes = {}
+
+    def replace(self, pending_users):
+        '''Replace the index with pending_users found by the scan'''
+        changes, self._changes = self._changes or {}, None
+        self.users = {}
+        self.by_admin = collections.defaultdict(dict)
+        for pending_user in pending_users:
+            self.add(pending_user)
+        for user_id, pending_user in changes.items():
+            if pending_user is None:
+                self.discard(user_id)
+            else:
+                self.add(pending_user)
+
+    def of_admin(self, admin) -> list:
+        '''Return users waiting for the admin, the longest waiting first'''
+        return sorted(self.by_admin.get(admin, {}).values(), key=lambda p: p.since)
+
+    def counts(self) -> dict:
+        '''Return {admin: number of users waiting}'''
+        return {admin: len(waiting) for admin, waiting in self.by_admin.items()}
+
+
+class AdminRouter:
+    '''Choose the admin an admission request goes to
+    - 'round-robin'   - candidates take turns;
+    - 'least-pending' - the one with the fewest users waiting for them
+                        (ties are broken in turns).
+    Turns are counted per set of candidates
+    '''
+    modes = ('round-robin', 'least-pending')
+
+    def __init__(self, mode: str = 'round-robin'):
+        assert mode in self.modes, f'Admin routing should be one of {self.modes}, not {mode}'
+        self.mode = mode
+        self._turns = {}
+
+    def choose(self, candidates, pending_counts=None):
+        '''pending_counts ({admin: waiting users}) is used by least-pending'''
+        candidates = tuple(candidates)
+        turn = self._turns.get(candidates, 0) % len(candidates)
+        self._turns[candidates] = turn + 1
+        rotated = candidates[turn:] + candidates[:turn]
+        if self.mode == 'least-pending':
+            return min(rotated, key=lambda admin: pending_counts.get(admin, 0))
+        return rotated[0]
+
+
+def render(pending, topics: dict, messages: dict, page: int, selected: set, page_size: int = PAGE_SIZE):
+    '''Return text and keyboard of the dashboard page, page number actually
+    shown (pages past the end show the last one) and drop users who are not
+    waiting anymore from selected
+    '''
+    selected.intersection_update(p.user_id for p in pending)
+    if not pending:
+        return messages['dashboard_empty'], None, 0
+    by_topic = collections.Counter(p.topic_code for p in pending)
+    header = [messages['dashboard_title'].format(len(pending))]
+    for topic_code, count in by_topic.items():
+        header.append(f'{clip(topic_name(topics, topic_code), INFO_LENGTH)} ({topic_code}): {count}')
+    header.append('')
+    now = time.time()
+    users = [
+        f'{number}. {clip(p.user_info, INFO_LENGTH)} | {clip(p.tg_info, INFO_LENGTH)} | '
+        f'{p.topic_code}, {max(0, int(now - p.since) // 60)} min'
+        for number, p in enumerate(pending, 1)
+    ]
+    page_size = fit_page_size(header, users, page_size)
+    pages = max(1, -(-len(pending) // page_size))
+    page = min(max(page, 0), pages - 1)
+    first = page * page_size
+    lines = header + users[first:first + page_size]
+    keyboard = types.InlineKeyboardMarkup(row_width=1)
+    for number, p in enumerate(pending[first:first + page_size], first + 1):
+        mark = '✅' if p.user_id in selected else '☐'
+        keyboard.add(types.InlineKeyboardButton(f'{mark} {number}. {p.user_info[:30]}', callback_data=f'dsel_{p.user_id}'))
+    if pages > 1:
+        lines.append(f'\n{page + 1}/{pages}')
+        keyboard.row(
+            types.InlineKeyboardButton('◀', callback_data=f'dpage_{(page - 1) % pages}'),
+            types.InlineKeyboardButton('🔄', callback_data=f'dpage_{page}'),
+            types.InlineKeyboardButton('▶', callback_data=f'dpage_{(page + 1) % pages}'),
+        )
+    else:
+        keyboard.add(types.InlineKeyboardButton('🔄', callback_data=f'dpage_{page}'))
+    if selected:
+        keyboard.row(
+            types.InlineKeyboardButton(messages['dashboard_admit_selected'].format(len(selected)), callback_data='dadm'),
+            types.InlineKeyboardButton(messages['dashboard_reject_selected'].format(len(selected)), callback_data='drej'),
+        )
+    for topic_code, count in by_topic.items():
+        text = messages['dashboard_admit_all'].format(topic_name(topics, topic_code), count)
+        keyboard.add(types.InlineKeyboardButton(text, callback_data=f'dall_{topic_code}'))
+    text = '\n'.join(lines)
+    # Only the header can be that long (lots of topics)
+    text = clip(text, MESSAGE_LIMIT)
+    return text, keyboard, page
+
+
+def fit_page_size(header, lines, page_size: int) -> int:
+    '''Return the largest page size (up to page_size) at which every page of
+    lines fits into a message along with header
+    '''
+    budget = MESSAGE_LIMIT - utf16_length('\n'.join(header)) - PAGES_LENGTH
+    lengths = [utf16_length(line) + 1 for line in lines]
+    while page_size > 1 and any(sum(lengths[i:i + page_size]) > budget for i in range(0, len(lengths), page_size)):
+        page_size -= 1
+    return page_size
+
+
+def clip(text: str, length: int) -> str:
+    '''Return text cut to length characters as Bot API counts them (ellipsis
+    included)
+    '''
+    if utf16_length(text) <= length:
+        return text
+    # A surrogate pair cut in half is dropped by the decoder
+    return text.encode('utf-16-le')[:(length - 1) * 2].decode('utf-16-le', errors='ignore') + '…'
+
+
+def topic_name(topics: dict, topic_code: str) -> str:
+    topic = topics.get(topic_code)
+    return topic['name'] if topic else topic_code
+
+
+async def fan_out(func, items, concurrency: int = 10):
+    '''Await func(item) for every item, no more than concurrency at a time
+    Return results in the order of items (exceptions are returned as well)
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(item):
+        async with semaphore:
+            return await func(item)
+
+    return await asyncio.gather(*(run(item) for item in items), return_exceptions=True)
@@ -0,0 +1,94 @@
+import array
+import collections
+import mmap
+import pickle
+import struct
+
+
+MAGIC = b'QUIZBANK'
+# Offset of the header, the last 8 bytes of the file
+TRAILER = struct.Struct('<Q')
+HOT_QUESTIONS = 1024
+
+
+class QuestionBank:
+    '''Questions of a compiled bank file, read lazily
+
+    The file is memory-mapped, so only the pages actually touched are read
+    (and they belong to the OS page cache, not to the bot process). A
+    question is unpickled when it is asked for, the last hot ones are kept
+    in an LRU cache. Indexing works like a tuple of Questions
+
+    Layout (see write_bank()):
+    MAGIC | pickled questions | offsets of questions (uint64) |
+    index arrays (uint32) | pickled header | offset of the header (uint64)
+    '''
+
+    def __init__(self, path, hot: int = HOT_QUESTIONS):
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a question bank')
+        header_offset, = TRAILER.unpack_from(self._map, len(self._map) - TRAILER.size)
+        self.header = pickle.loads(self._map[header_offset:len(self._map) - TRAILER.size])
+        offset, count = self.header['offsets']
+        self._offsets = memoryview(self._map)[offset:offset + 8 * (count + 1)].cast('Q')
+        self.hot = hot
+        self._hot = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: int):
+        question = self._hot.get(index)
+        if question is not None:
+            self._hot.move_to_end(index)
+            return question
+        question = self.load(index)
+        self._hot[index] = question
+        if len(self._hot) > self.hot:
+            self._hot.popitem(last=False)
+        return question
+
+    def load(self, index: int):
+        '''Read the question bypassing hot ones (e.g. for a pass over many)'''
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return pickle.loads(self._map[self._offsets[index]:self._offsets[index + 1]])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def array(self, name: str) -> memoryview:
+        '''Return index array saved under name (read-only, not copied)'''
+        offset, count = self.header['arrays'][name]
+        return memoryview(self._map)[offset:offset + 4 * count].cast('I')
+
+
+def write_bank(path, questions, arrays: dict, header: dict):
+    '''Write questions (pickled one by one) and arrays ({name: sequence of
+    non-negative ints}) for QuestionBank, header is saved as is along with
+    positions of the questions and arrays
+    '''
+    header = dict(header, arrays={})
+    with open(path, 'wb') as file:
+        file.write(MAGIC)
+        offsets = array.array('Q')
+        for question in questions:
+            offsets.append(file.tell())
+            file.write(pickle.dumps(question, protocol=pickle.HIGHEST_PROTOCOL))
+        offsets.append(file.tell())
+        align(file)
+        header['offsets'] = (file.tell(), len(offsets) - 1)
+        offsets.tofile(file)
+        for name, values in arrays.items():
+            header['arrays'][name] = (file.tell(), len(values))
+            array.array('I', values).tofile(file)
+        header_offset = file.tell()
+        file.write(pickle.dumps(header, protocol=pickle.HIGHEST_PROTOCOL))
+        file.write(TRAILER.pack(header_offset))
+
+
+def align(file, size: int = 8):
+    file.write(b'\0' * (-file.tell() % size))
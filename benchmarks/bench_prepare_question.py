@@ -0,0 +1,92 @@
+'''Per-question latency of prepare_question() before and after precompiling
+questions in Quizes.load()
+
+Run from the repository root:
+    python benchmarks/bench_prepare_question.py [quizes.yaml]
+'''
+import pathlib
+import sys
+import timeit
+from random import sample
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from aiogram import types
+
+from quizes import Quizes, load_yaml, my_md, prepare_question
+
+
+def legacy_format_answer(use_md, letter, answer):
+    result = letter + ('\\' if use_md else '') + '. '
+    result += legacy_my_md(answer) if use_md else answer
+    return result
+
+
+def legacy_my_md(text, plaintext=False):
+    '''my_md() as it was before: one str.replace() pass per character'''
+    if text.startswith('MD:') or plaintext:
+        return my_md(text, plaintext)
+    result = text
+    for letter in '_*[]()~`>#+-=|{}.!':
+        result = result.replace(letter, '\\' + letter)
+    return result
+
+
+def legacy_prepare_question(questions, topics, topic_code, q_id):
+    '''prepare_question() as it was before: renders the raw yaml record'''
+    letters = 'ABCDEFGHIJ'
+    topic = topics[topic_code]
+    if q_id > topic['q_count'] - 1:
+        return (None, None, None, None)
+    top_question = questions[topic['q_indices'][q_id]]
+    final_q = top_question['q']
+    raw_answers = list(map(str, top_question['a']))
+    correct_answer = raw_answers[0]
+    use_md = final_q.startswith('MD:') or any(
+        map(lambda s: s.startswith('MD:'), raw_answers))
+    if use_md:
+        final_q = legacy_my_md(final_q)
+    random_answers = sample([(a, int(a == correct_answer))
+                            for a in raw_answers], len(raw_answers))
+    buttons = []
+    for i, (answer, points) in enumerate(random_answers):
+        delimiter = '\n' if i else '\n\n'
+        final_q += delimiter + legacy_format_answer(use_md, letters[i], answer)
+        buttons.append(types.InlineKeyboardButton(
+            letters[i], callback_data=str(points)))
+    keyboard_markup = types.InlineKeyboardMarkup()
+    keyboard_markup.row(*buttons)
+    parse_mode = 'MarkdownV2' if use_md else ''
+    return (final_q, keyboard_markup, parse_mode, legacy_my_md(correct_answer, plaintext=True))
+
+
+def bench(func, rounds):
+    '''Return the best per-call time in microseconds'''
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=rounds, number=number)) / number * 1e6
+
+
+def main(filename):
+    quizes = Quizes(filename)
+    raw_questions = load_yaml(filename)['questions']
+    print(f'{filename}: {len(quizes.questions)} questions, {len(quizes.topics)} topics')
+    print(f"{'topic':<20} {'before, us':>12} {'after, us':>12} {'speedup':>8}")
+    for topic_code, topic in quizes.topics.items():
+        q_ids = range(topic['q_count'])
+
+        def before():
+            for q_id in q_ids:
+                legacy_prepare_question(raw_questions, quizes.topics, topic_code, q_id)
+
+        def after():
+            for q_id in q_ids:
+                prepare_question(quizes, topic_code, q_id)
+
+        before_us = bench(before, 5) / topic['q_count']
+        after_us = bench(after, 5) / topic['q_count']
+        print(f'{topic_code:<20} {before_us:>12.2f} {after_us:>12.2f} {before_us / after_us:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else 'quizes_sample.yaml')
@@ -0,0 +1,80 @@
+'''Time to load a large generated quizes file: pure-Python yaml loader,
+libyaml loader (if PyYAML was built with it) and the compiled cache, and
+memory kept by the loaded questions with and without the cache
+
+Run from the repository root:
+    python benchmarks/bench_startup.py [questions_count]
+'''
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import yaml
+
+import quizes
+
+
+def generate_quizes(filename, q_count, t_count=20):
+    '''Write a quizes file with q_count questions spread over t_count topics'''
+    with open(filename, 'w', encoding='utf8') as file:
+        file.write('enabled_topics:\n')
+        for t in range(t_count):
+            file.write(f'  topic-{t}:\n    name: Topic {t}\n    tags: [ show-correct ]\n')
+        file.write('questions:\n')
+        for q in range(q_count):
+            md = 'MD:' if q % 5 == 0 else ''
+            file.write(
+                f'  - t: topic-{q % t_count} topic-{(q * 7) % t_count}\n'
+                f'    q: {md}Question number {q} about *something* (with some text)?\n'
+                f'    a:\n'
+                f'      - Correct answer {q}\n'
+                f'      - Wrong answer {q}-1\n'
+                f'      - Wrong answer {q}-2\n'
+                f'      - Wrong answer {q}-3\n'
+            )
+
+
+def measure(filename, cache_filename=None):
+    started = time.perf_counter()
+    quizes.Quizes(filename, cache_filename)
+    return time.perf_counter() - started
+
+
+def retained(filename, cache_filename=None):
+    '''Return bytes allocated by Quizes() and still kept after loading'''
+    tracemalloc.start()
+    loaded = quizes.Quizes(filename, cache_filename)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del loaded
+    return size
+
+
+def main(q_count):
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = f'{tmp}/quizes.yaml'
+        cache_filename = f'{tmp}/quizes.cache'
+        generate_quizes(filename, q_count)
+        size = pathlib.Path(filename).stat().st_size
+        print(f'{q_count} questions, {size / 2**20:.1f} MiB')
+
+        loader = quizes.YAML_LOADER
+        quizes.YAML_LOADER = yaml.SafeLoader
+        print(f"{'SafeLoader':<24} {measure(filename):>8.3f} s")
+        quizes.YAML_LOADER = loader
+        if loader is not yaml.SafeLoader:
+            print(f"{'CSafeLoader':<24} {measure(filename):>8.3f} s")
+        else:
+            print(f"{'CSafeLoader':<24} {'n/a':>8} (PyYAML is built without libyaml)")
+        print(f"{'cache miss (and save)':<24} {measure(filename, cache_filename):>8.3f} s")
+        print(f"{'cache hit':<24} {measure(filename, cache_filename):>8.3f} s")
+        print(f"{'memory, no cache':<24} {retained(filename) / 2**20:>8.1f} MiB")
+        print(f"{'memory, cache':<24} {retained(filename, cache_filename) / 2**20:>8.1f} MiB")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
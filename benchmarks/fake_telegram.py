@@ -0,0 +1,162 @@
+'''Local stand-in for the Telegram Bot API used by the load test
+
+Implements just enough of getMe, getWebhookInfo, getUpdates, sendMessage, editMessageText,
+deleteMessage(s) and answerCallbackQuery for bot.py; any other method
+answers True. Everything the bot sends is routed to per-chat queues, so
+simulated users can wait for the bot's reactions
+'''
+import asyncio
+import itertools
+import json
+import time
+
+from aiohttp import web
+
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Quiz', 'username': 'quiz_bot'}
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.updates = []
+        self.new_updates = asyncio.Event()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.callback_ids = itertools.count(1)
+        self.messages = {}  # (chat_id, message_id) -> message
+        self.chats = {}  # chat_id -> asyncio.Queue of (method, params, message)
+        self.calls = {}  # method -> count
+        self.polling = asyncio.Event()
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        '''Start serving, return base URL for TelegramAPIServer.from_base()'''
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f'http://{host}:{port}'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def chat_queue(self, chat_id: int) -> asyncio.Queue:
+        return self.chats.setdefault(chat_id, asyncio.Queue())
+
+    # Simulated users' side
+
+    def user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+    def push_update(self, update: dict):
+        update['update_id'] = next(self.update_ids)
+        self.updates.append(update)
+        self.new_updates.set()
+
+    def send_text(self, user_id: int, text: str):
+        self.push_update({'message': {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self.user(user_id),
+            'text': text,
+        }})
+
+    def press_button(self, user_id: int, message: dict, data: str):
+        self.push_update({'callback_query': {
+            'id': str(next(self.callback_ids)),
+            'from': self.user(user_id),
+            'message': message,
+            'chat_instance': str(user_id),
+            'data': data,
+        }})
+
+    async def wait_for(self, chat_id: int, predicate, timeout: float = 60):
+        '''Return (method, params, message) of the first bot request to the
+        chat matching predicate, skipping the others
+        '''
+        queue = self.chat_queue(chat_id)
+        deadline = time.monotonic() + timeout
+        while True:
+            call = await asyncio.wait_for(queue.get(), deadline - time.monotonic())
+            if predicate(*call):
+                return call
+
+    # Bot's side
+
+    async def handle(self, request: web.Request):
+        method = request.match_info['method']
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+        handler = getattr(self, f'api_{method}', None)
+        result = await handler(params) if handler else True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def api_getMe(self, params):
+        return BOT_USER
+
+    async def api_getWebhookInfo(self, params):
+        return {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+
+    async def api_getUpdates(self, params):
+        self.polling.set()
+        offset = int(params.get('offset', 0))
+        self.updates = [u for u in self.updates if u['update_id'] >= offset]
+        if not self.updates:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), float(params.get('timeout', 0)) or 0.1)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:int(params.get('limit', 100))]
+
+    async def api_sendMessage(self, params):
+        chat_id = int(params['chat_id'])
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            'text': params['text'],
+        }
+        if params.get('reply_markup'):
+            message['reply_markup'] = json.loads(params['reply_markup'])
+        self.messages[(chat_id, message['message_id'])] = message
+        self.chat_queue(chat_id).put_nowait(('sendMessage', params, message))
+        return message
+
+    async def api_editMessageText(self, params):
+        chat_id = int(params['chat_id'])
+        message = dict(self.messages.get((chat_id, int(params['message_id'])), {}))
+        message.update({
+            'message_id': int(params['message_id']),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'edit_date': int(time.time()),
+            'from': BOT_USER,
+            'text': params['text'],
+        })
+        message.pop('reply_markup', None)
+        if params.get('reply_markup'):
+            message['reply_markup'] = json.loads(params['reply_markup'])
+        self.messages[(chat_id, message['message_id'])] = message
+        self.chat_queue(chat_id).put_nowait(('editMessageText', params, message))
+        return message
+
+    async def api_deleteMessage(self, params):
+        self.messages.pop((int(params['chat_id']), int(params['message_id'])), None)
+        return True
+
+    async def api_deleteMessages(self, params):
+        chat_id = int(params['chat_id'])
+        for message_id in json.loads(params['message_ids']):
+            self.messages.pop((chat_id, message_id), None)
+        return True
+
+
+def buttons(message: dict) -> list:
+    '''Return callback data of all inline buttons of the message'''
+    markup = message.get('reply_markup') or {}
+    return [b['callback_data'] for row in markup.get('inline_keyboard', []) for b in row]
@@ -0,0 +1,187 @@
+'''Run bot.py against a local fake Bot API with N simulated quiz takers
+
+Every user goes through /info -> user info -> /topic -> topic selection ->
+admission -> answers, a simulated admin admits everybody from the admission
+dashboard. Reports throughput, p50/p99 latency of every step and storage
+writes (from the bot's own metrics). Note that every step includes up to
+0.1 s that aiogram's polling sleeps between getUpdates calls
+
+Run from the repository root:
+    python benchmarks/loadtest.py --users 200 --storage wal --flush-mode interval
+'''
+import argparse
+import asyncio
+import pathlib
+import random
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from bench_startup import generate_quizes
+from fake_telegram import FakeTelegram, buttons
+
+
+REPO = pathlib.Path(__file__).resolve().parent.parent
+FIRST_ADMIN = 10
+STEPS = ('info', 'user_info', 'topic', 'admission', 'answer')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def write_config(tmp: pathlib.Path, api_server: str, metrics_port: int, args):
+    (tmp / 'config.py').write_text(f'''token = '123456:LOADTEST'
+api_server = {api_server!r}
+storage_filename = {str(tmp / 'fsm_storage.json')!r}
+storage_type = {args.storage!r}
+flush_mode = {args.flush_mode!r}
+messages_filename = {str(REPO / 'messages.yaml')!r}
+quizes_filename = {str(tmp / 'quizes.yaml')!r}
+results_filename = {str(tmp / 'results.jsonl')!r}
+admins = {list(range(FIRST_ADMIN, FIRST_ADMIN + args.admins))}
+admin_routing = {args.admin_routing!r}
+admin_digest_interval = 1
+rate_limit_global = {args.rate_limit}
+rate_limit_chat = {args.rate_limit}
+rate_limit_chat_burst = {args.rate_limit}
+metrics_port = {metrics_port}
+metrics_interval = 3600
+lazy_startup = {args.lazy_startup}
+''')
+
+
+def is_sent(method, params, message):
+    return method == 'sendMessage'
+
+
+def has_buttons(method, params, message):
+    return method == 'sendMessage' and buttons(message)
+
+
+async def take_quiz(tg: FakeTelegram, user_id: int, topic: str, latencies: dict):
+    '''Go through the whole flow as a single user'''
+    async def step(name, action, predicate):
+        started = time.perf_counter()
+        action()
+        call = await tg.wait_for(user_id, predicate)
+        latencies[name].append(time.perf_counter() - started)
+        return call
+
+    await step('info', lambda: tg.send_text(user_id, '/info'), is_sent)
+    await step('user_info', lambda: tg.send_text(user_id, f'User {user_id}'), is_sent)
+    _, _, topics_msg = await step('topic', lambda: tg.send_text(user_id, '/topic'), has_buttons)
+    _, _, question = await step('admission', lambda: tg.press_button(user_id, topics_msg, topic), has_buttons)
+    while True:
+        def answered(method, params, message):
+            if method == 'editMessageText':
+                return message['message_id'] == question['message_id']
+            return method == 'sendMessage'
+        data = random.choice(buttons(question))
+        method, _, message = await step('answer', lambda: tg.press_button(user_id, question, data), answered)
+        if method == 'sendMessage':
+            # Results
+            return
+        question = message
+
+
+async def admit_everybody(tg: FakeTelegram, admin: int):
+    '''Press "admit all" buttons of the admission dashboard as they appear'''
+    def dashboard(method, params, message):
+        return any(b.startswith('dall_') for b in buttons(message))
+
+    while True:
+        try:
+            _, _, message = await tg.wait_for(admin, dashboard, timeout=3600)
+        except asyncio.TimeoutError:
+            continue
+        for data in buttons(message):
+            if data.startswith('dall_'):
+                tg.press_button(admin, message, data)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+async def scrape(metrics_port: int) -> dict:
+    '''Return {metric_name_with_labels: value} from the bot's /metrics'''
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f'http://127.0.0.1:{metrics_port}/metrics') as response:
+            text = await response.text()
+    result = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            result[name] = float(value)
+    return result
+
+
+async def main(args):
+    tg = FakeTelegram()
+    api_server = await tg.start()
+    metrics_port = free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        generate_quizes(tmp / 'quizes.yaml', args.questions * args.topics, args.topics)
+        write_config(tmp, api_server, metrics_port, args)
+        argv = ['bot.py'] + (['--profile-startup'] if args.profile_startup else [])
+        code = (f'import runpy, sys; sys.argv = {argv!r}; sys.path.insert(1, {str(REPO)!r}); '
+                f'runpy.run_path({str(REPO / "bot.py")!r})')
+        bot = await asyncio.create_subprocess_exec(sys.executable, '-c', code, cwd=tmp)
+        try:
+            await asyncio.wait_for(tg.polling.wait(), 60)
+            admins = [asyncio.ensure_future(admit_everybody(tg, FIRST_ADMIN + i)) for i in range(args.admins)]
+            latencies = {name: [] for name in STEPS}
+            started = time.perf_counter()
+            users = [
+                take_quiz(tg, 1000 + i, f'topic-{i % args.topics}', latencies)
+                for i in range(args.users)
+            ]
+            results = await asyncio.gather(*users, return_exceptions=True)
+            elapsed = time.perf_counter() - started
+            for admin in admins:
+                admin.cancel()
+            bot_metrics = await scrape(metrics_port)
+        finally:
+            bot.send_signal(signal.SIGINT)
+            await bot.wait()
+        await tg.stop()
+
+    failed = [r for r in results if isinstance(r, BaseException)]
+    print(f'\n{args.users} users, {args.admins} admins, storage {args.storage}, flush {args.flush_mode}: '
+          f'{elapsed:.2f} s, {len(failed)} failed')
+    if failed:
+        print(f'First failure: {failed[0]!r}')
+    answers = len(latencies['answer'])
+    print(f'Throughput: {(args.users - len(failed)) / elapsed:.1f} quizes/s, {answers / elapsed:.1f} answers/s')
+    print(f"{'step':<12} {'count':>7} {'p50, ms':>9} {'p99, ms':>9}")
+    for name in STEPS:
+        values = latencies[name]
+        print(f'{name:<12} {len(values):>7} {percentile(values, 0.5) * 1000:>9.1f} {percentile(values, 0.99) * 1000:>9.1f}')
+    writes = bot_metrics.get('quizbot_storage_write_seconds_count', 0)
+    chars = bot_metrics.get('quizbot_storage_write_characters_total', 0)
+    print(f'Storage: {writes:.0f} writes, {chars / 2**20:.2f} MiB written')
+    print(f'Bot API calls: {tg.calls}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--topics', type=int, default=5)
+    parser.add_argument('--admins', type=int, default=1)
+    parser.add_argument('--admin-routing', default='round-robin', choices=('round-robin', 'least-pending'))
+    parser.add_argument('--questions', type=int, default=10, help='questions per topic')
+    parser.add_argument('--storage', default='wal', choices=('json', 'wal'))
+    parser.add_argument('--flush-mode', default='interval', choices=('always', 'interval', 'exit'))
+    parser.add_argument('--lazy-startup', action='store_true', help='poll while loading the storage and quizes')
+    parser.add_argument('--profile-startup', action='store_true', help="print the bot's startup profile")
+    parser.add_argument('--rate-limit', type=float, default=10000, help='requests per second (global and per chat)')
+    asyncio.run(main(parser.parse_args()))
@@ -1,78 +1,107 @@
-import yaml
-from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.files import JSONStorage
+import time
+
+# Taken before the other imports, see --profile-startup
+STARTED = time.perf_counter()
+
+import asyncio
+import contextlib
+import functools
+import json
+import signal
+import string
+import sys
+
+from aiogram import Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.utils import executor
+from aiohttp import web
 
 
+import admissions
 import config
+import metrics
+import webhook
+from adaptive import STABLE_ANSWERS, START_LEVEL, DifficultyIndex, next_level, settled
+from admissions import AdminRouter, Dashboard, Digest, PendingIndex, PendingUser, fan_out
+from banks import HOT_QUESTIONS
+from callbacks import ANSWER_PATTERN, AnswerSigner, derive_key
+from cleanup import MessageCleaner
+from draws import new_seed
+from metrics import ACTIVE_QUIZES, QUEUE_DEPTH, RESULTS_WRITE_CHARS, RESULTS_WRITE_SECONDS, InstrumentedBot, MetricsMiddleware
+from middlewares import ActivityMiddleware, ChatLockMiddleware, ReadinessMiddleware
+from outbound import PRIORITY_ADMIN, PRIORITY_NAMES, PRIORITY_QUIZ, PRIORITY_USER, OutboundScheduler
+from quizes import MESSAGE_LIMIT, Quizes, answer_order, get_question, load_yaml, prepare_question, utf16_length
+from results import ResultLog, stats_report
+from sessions import SessionGC, gc_report
+from startup import StartupProfile
+from storage import AtomicJSONStorage, FlushScheduler, RedisStorage, WALStorage
+from timers import DeadlineScheduler
+
+
+profile = StartupProfile(STARTED)
+profile.mark('imports')
+PROFILE_STARTUP = '--profile-startup' in sys.argv
+# Poll right away and load the storage, quizes and result log meanwhile
+LAZY_STARTUP = getattr(config, 'lazy_startup', False)
+
+if getattr(config, 'api_server', None):
+    bot = InstrumentedBot(token=config.token, server=TelegramAPIServer.from_base(config.api_server))
+else:
+    bot = InstrumentedBot(token=config.token)
+storage_type = getattr(config, 'storage_type', 'json')
+# Files are read by prepare() on startup
+if storage_type == 'wal':
+    storage = WALStorage(path=config.storage_filename, load=False)
+elif storage_type == 'redis':
+    storage = RedisStorage(url=config.redis_url, prefix=getattr(config, 'redis_prefix', 'quiz-bot'))
+else:
+    storage = AtomicJSONStorage(path=config.storage_filename, load=False)
+dp = Dispatcher(bot, storage=storage)
+ready = asyncio.Event()
+# Parts read by prepare(), the others are not flushed on shutdown (their files
+# would be overwritten with whatever little is in memory)
+loaded = set()
+dp.middleware.setup(ReadinessMiddleware(ready))
+dp.middleware.setup(ChatLockMiddleware(storage))
+dp.middleware.setup(MetricsMiddleware())
+persistence = FlushScheduler(
+    storage,
+    mode=getattr(config, 'flush_mode', 'always'),
+    interval=getattr(config, 'flush_interval', 1.0),
+    batch_size=getattr(config, 'flush_batch_size', 100),
+)
+activity = ActivityMiddleware(storage, persistence.mark_dirty)
+dp.middleware.setup(activity)
+outbound = OutboundScheduler(
+    global_rate=getattr(config, 'rate_limit_global', 30),
+    chat_rate=getattr(config, 'rate_limit_chat', 1),
+    chat_burst=getattr(config, 'rate_limit_chat_burst', 3),
+)
+cleaner = MessageCleaner(bot, concurrency=getattr(config, 'delete_concurrency', 10), outbound=outbound)
+if getattr(config, 'results_filename', None):
+    results = ResultLog(config.results_filename, rotate_bytes=getattr(config, 'results_rotate_bytes', 64 * 2**20), load=False)
+    results_persistence = FlushScheduler(
+        results,
+        mode='interval',
+        interval=getattr(config, 'flush_interval', 1.0),
+        batch_size=getattr(config, 'flush_batch_size', 100),
+        write_seconds=RESULTS_WRITE_SECONDS,
+        write_chars=RESULTS_WRITE_CHARS,
+    )
+else:
+    results = None
 
 
-bot = Bot(token=config.token)
-storage = JSONStorage(path=config.storage_filename)
-dp = Dispatcher(bot, storage=storage)
+async def send_message(priority: int, chat_id, text: str, **kwargs) -> types.Message:
+    '''bot.send_message() through the outbound rate limiter'''
+    return await outbound.run(priority, chat_id, bot.send_message, chat_id, text, **kwargs)
 
 
-class Quizes:
-    def __init__(self, filename: str):
-        self.filename = filename
-        self.load()
-
-    def reload(self):
-        '''Just an alias to load()'''
-        self.load()
-
-    def load(self):
-        '''Load quizes from file'''
-        yaml_from_file = load_yaml(self.filename)
-        assert yaml_from_file is not None, f'Check that there is a correct file {self.filename}'
-        self.questions = yaml_from_file['questions']
-        self.topics = self.parse_topics(yaml_from_file['enabled_topics'])
-
-    def parse_topics(self, enabled_topics):
-        '''Return a dictionary of topics within enabled_topics that have at
-        least one question the key is topic_code, the value is a dictionary
-        with keys: 'name', 'q_count', etc
-        {
-            'ccna': {
-                'name': 'CCNA',
-                'q_count': 20,
-                'show-correctness': False,
-                'show-correct': False,
-                'q_indices': [0, 1, 7],
-                },
-        }
-        '''
-        topics = {}
-        for index, question in enumerate(self.questions):
-            # Loop through every question
-            for q_topic in set(question['t'].split()):
-                # And every space-separated topic within the question
-                if q_topic in enabled_topics:
-                    # Make sure topic is initialized
-                    topics.setdefault(
-                        q_topic,
-                        {
-                            'name': enabled_topics[q_topic]['name'],
-                            'show-correctness': 'show-correctness' in enabled_topics[q_topic].get('tags', []),
-                            'show-correct': 'show-correct' in enabled_topics[q_topic].get('tags', []),
-                            'q_indices': [],
-                        },
-                    )
-                    topics[q_topic]['q_indices'].append(index)
-        for topic_code in topics.keys():
-            topics[topic_code]['q_count'] = len(topics[topic_code]['q_indices'])
-        return topics
-
-
-def load_yaml(filename):
-    '''Load yaml-file or return None if file does not exist'''
-    try:
-        with open(filename, 'r', encoding='utf8') as file:
-            return yaml.safe_load(file)
-    except FileExistsError:
-        return None
+async def edit_message(priority: int, chat_id, msg_id, text: str, **kwargs):
+    '''bot.edit_message_text() through the outbound rate limiter'''
+    return await outbound.run(priority, chat_id, bot.edit_message_text, text, chat_id, msg_id, **kwargs)
 
 
 def user_info_ok(user_info):
@@ -102,30 +131,45 @@ class Quiz(StatesGroup):
 
 async def del_other_msgs(state: FSMContext, final_msg_id=None):
     '''Delete all messages within the 'delete' list of the state (chat_id is
-    also taken from a state object)
+    also taken from a state object) in the background
     Optionally add final_msg_id to the 'delete' list (to be deleted later on)
     '''
     data = await state.get_data()
     msgs_to_delete = data.get('delete', [])
-    chat_id = state.chat
-    for msg_id in msgs_to_delete.copy():
-        result = await bot.delete_message(chat_id, msg_id)
-        if result:
-            msgs_to_delete.remove(msg_id)
-    if msgs_to_delete:
-        print(f'Oops, messages were not deleted: {msgs_to_delete}')
-    if final_msg_id:
-        msgs_to_delete.append(final_msg_id)
     if data or final_msg_id:
-        await state.update_data({'delete': msgs_to_delete})
-        dp.storage.write(dp.storage.path)
+        await state.update_data({'delete': [final_msg_id] if final_msg_id else []})
+        await persistence.mark_dirty()
+    if msgs_to_delete:
+        cleaner.schedule(state.chat, msgs_to_delete, on_retry=functools.partial(keep_other_msgs, state))
+
+
+async def keep_other_msgs(state: FSMContext, msg_ids):
+    '''Put messages which could not be deleted for now (flood control,
+    network errors) back to the 'delete' list to try again next time
+    '''
+    async with dp.storage.lock(state.chat):
+        data = await state.get_data()
+        await state.update_data({'delete': msg_ids + data.get('delete', [])})
+    await persistence.mark_dirty()
+
+
+def other_chat_lock(chat_id, current_chat_id):
+    '''Return storage lock for chat_id, or a dummy one if chat_id is the
+    chat of the current update (already locked by ChatLockMiddleware)
+    '''
+    if str(chat_id) == str(current_chat_id):
+        return contextlib.nullcontext()
+    return dp.storage.lock(chat_id)
 
 
 @dp.message_handler(state='*', commands='finish')
 async def cmd_finish(msg: types.Message, state: FSMContext):
     '''Erase all the data of the user'''
+    if await state.get_state() == Quiz.get_admission.state:
+        dashboard(user_admin(await state.get_data())).request_refresh()
+        await pending_changed(state.user)
     await state.finish()
-    dp.storage.write(dp.storage.path)
+    await persistence.mark_dirty()
     await cmd_cancel(msg, state)
 
 
@@ -135,45 +179,101 @@ async def cmd_cancel(msg: types.Message, state: FSMContext):
     'delete' list within the state, save resulting data
     '''
     await del_other_msgs(state)
-    await msg.delete()
+    cleaner.schedule(msg.chat.id, [msg.message_id])
     cur_state = await state.get_state()
     data = await state.get_data()
     if cur_state == None:
         return
     elif cur_state == 'Quiz:quiz':
-        admin_text_new = data.get('admin_msg_text') + f"\n\n{MESSAGES['test_canceled']}"
-        try:
-            await bot.edit_message_text(admin_text_new, ADMIN, data.get('admin_msg_id'))
-        except:
-            await bot.send_message(ADMIN, MESSAGES['test_canceled'], reply_to_message_id=data.get('admin_msg_id'))
+        deadlines.cancel(str(state.user))
+        await notify_admin(data, MESSAGES['test_canceled'])
+    elif cur_state == 'Quiz:get_admission':
+        dashboard(user_admin(data)).request_refresh()
+        await pending_changed(state.user)
     if data.get('qmessage_id'):
-        await bot.delete_message(state.user, data.get('qmessage_id'))
+        cleaner.schedule(state.user, [data.get('qmessage_id')])
     data = clear_data(data)
     await state.set_data(data)
     await state.reset_state(with_data=False)
-    dp.storage.write(dp.storage.path)
+    await persistence.mark_dirty()
 
 
 @dp.message_handler(commands=['start', 'help'])
 async def cmd_start(msg: types.Message, state: FSMContext):
-    msg_start = await msg.answer(MESSAGES['start'])
+    msg_start = await send_message(PRIORITY_USER, msg.chat.id, MESSAGES['start'])
     await del_other_msgs(state, msg_start.message_id)
-    await msg.delete()
+    cleaner.schedule(msg.chat.id, [msg.message_id])
 
 
 @dp.message_handler(commands=['reload'])
 async def cmd_reload(msg: types.Message):
-    if msg.chat.id == ADMIN:
-        quizes.reload()
-    await msg.delete()
+    if msg.chat.id in ADMINS:
+        old_version = quizes.version
+        report = await quizes.reload(await active_quiz_versions())
+        await asyncio.get_running_loop().run_in_executor(None, refresh_difficulty)
+        if quizes.version != old_version and isinstance(storage, RedisStorage):
+            # Make other bot processes reload as well
+            await storage.publish('quizes', quizes.version)
+        await send_message(PRIORITY_ADMIN, msg.chat.id, report)
+    cleaner.schedule(msg.chat.id, [msg.message_id])
+
+
+@dp.message_handler(commands=['qstats'])
+async def cmd_qstats(msg: types.Message):
+    '''Show per-question statistics (of a topic if it is given) to the admin'''
+    if msg.chat.id in ADMINS:
+        topic_code = msg.get_args() or None
+        if results is None:
+            text = 'Result log is disabled'
+        elif topic_code is not None and topic_code not in quizes.topics:
+            text = f'Unknown topic {topic_code}'
+        else:
+            loop = asyncio.get_running_loop()
+            text = await loop.run_in_executor(None, stats_report, results.stats, quizes.snapshot, topic_code)
+        await send_message(PRIORITY_ADMIN, msg.chat.id, text)
+    cleaner.schedule(msg.chat.id, [msg.message_id])
+
+
+@dp.message_handler(commands=['stats'])
+async def cmd_stats(msg: types.Message):
+    '''Show outbound queue statistics to the admin'''
+    if msg.chat.id in ADMINS:
+        stats = outbound.stats()
+        lines = [f"In flight: {stats.pop('in_flight')}, retries: {stats.pop('retries')}"]
+        for name, queue in stats.items():
+            lines.append(
+                f"{name}: queued {queue['queued']}, sent {queue['sent']}, "
+                f"wait avg {queue['wait_avg']:.2f}s, max {queue['wait_max']:.2f}s"
+            )
+        if session_gc.last_report is not None:
+            lines.append(gc_report(session_gc.last_report))
+        await send_message(PRIORITY_ADMIN, msg.chat.id, '\n'.join(lines))
+    cleaner.schedule(msg.chat.id, [msg.message_id])
+
+
+async def active_quiz_versions():
+    '''Return versions of quiz snapshots used by users within Quiz.quiz'''
+    versions = set()
+    async for chat, user, record in dp.storage.records():
+        if record.get('state') == 'Quiz:quiz':
+            versions.add(record['data'].get('quiz-version'))
+    return versions
+
+
+async def on_quizes_published(version: str):
+    '''Another bot process has reloaded quizes'''
+    await ready.wait()
+    if version != quizes.version:
+        print(await quizes.reload(await active_quiz_versions()))
+        await asyncio.get_running_loop().run_in_executor(None, refresh_difficulty)
 
 
 @dp.message_handler(commands='info')
 async def cmd_info(msg: types.Message, state: FSMContext):
     await Info.get_user_info.set()
-    msg_info = await msg.answer(MESSAGES['info'])
+    msg_info = await send_message(PRIORITY_USER, msg.chat.id, MESSAGES['info'])
     await del_other_msgs(state, msg_info.message_id)
-    await msg.delete()
+    cleaner.schedule(msg.chat.id, [msg.message_id])
 
 
 @dp.message_handler(state=Info.get_user_info)
@@ -184,20 +284,20 @@ async def fsm_get_user_info(msg: types.Message, state: FSMContext):
     if user_info_ok(msg.text):
         await Info.next()
         await state.update_data({'user_info': msg.text})
-        await msg.delete()
-        msg_topic = await msg.answer(MESSAGES['topic'])
+        cleaner.schedule(msg.chat.id, [msg.message_id])
+        msg_topic = await send_message(PRIORITY_USER, msg.chat.id, MESSAGES['topic'])
         msg_to_delete = msg_topic.message_id
-        dp.storage.write(dp.storage.path)
+        await persistence.mark_dirty()
     else:
-        msg_info = await msg.answer(MESSAGES['info_allowed_characters'])
+        msg_info = await send_message(PRIORITY_USER, msg.chat.id, MESSAGES['info_allowed_characters'])
         msg_to_delete = msg_info.message_id
-        await msg.delete()
+        cleaner.schedule(msg.chat.id, [msg.message_id])
     await del_other_msgs(state, msg_to_delete)
 
 
 def get_kb_topics(topics):
     '''Return an inline keyboard with all available topics' names as well as
-    number of questions within each
+    number of questions within each, serialized to be sent as reply_markup
     Callback data is set to the code of the topic
     '''
     keyboard_markup = types.InlineKeyboardMarkup(row_width=1)
@@ -210,24 +310,7 @@ def get_kb_topics(topics):
                                         callback_data=topic_code)
         )
     keyboard_markup.add(*buttons)
-    return keyboard_markup
-
-
-def get_kb_admit(user_id, topic_code):
-    '''Prepare admin's keyboard for admition decision'''
-    yes_text = MESSAGES['admit_buttons'][1]
-    no_text = MESSAGES['admit_buttons'][0]
-    text_and_data = (
-        (yes_text, f'admit_{user_id}_{topic_code}'),
-        (no_text, f'noadmit_{user_id}_{topic_code}'),
-    )
-    keyboard_markup = types.InlineKeyboardMarkup(row_width=1)
-    buttons = (
-        types.InlineKeyboardButton(text, callback_data=cb_data)
-        for text, cb_data in text_and_data
-    )
-    keyboard_markup.add(*buttons)
-    return keyboard_markup
+    return json.dumps(keyboard_markup.to_python(), ensure_ascii=False)
 
 
 @dp.message_handler(commands='topic')
@@ -238,12 +321,14 @@ async def cmd_topic(msg: types.Message, state: FSMContext):
     data = await state.get_data()
     if 'user_info' in data:
         await Quiz.get_topic.set()
-        keyboard_markup = get_kb_topics(quizes.topics)
-        msg_info = await msg.answer(MESSAGES['topic_select'], reply_markup=keyboard_markup)
+        snapshot = quizes.snapshot
+        # Topics only change on reload, and so does the keyboard
+        keyboard_markup = snapshot.render('topics-keyboard', lambda: get_kb_topics(snapshot.topics))
+        msg_info = await send_message(PRIORITY_USER, msg.chat.id, MESSAGES['topic_select'], reply_markup=keyboard_markup)
     else:
-        msg_info = await msg.answer(MESSAGES['start'])
+        msg_info = await send_message(PRIORITY_USER, msg.chat.id, MESSAGES['start'])
     await del_other_msgs(state, msg_info.message_id)
-    await msg.delete()
+    cleaner.schedule(msg.chat.id, [msg.message_id])
 
 
 def oneline_tg_info(user: types.User):
@@ -262,7 +347,8 @@ def oneline_tg_info(user: types.User):
 @dp.callback_query_handler(state=Quiz.get_topic)
 async def fsm_cb_query_get_topic(query: types.CallbackQuery, state: FSMContext):
     topic_code = query.data
-    if topic_code not in quizes.topics:
+    snapshot = quizes.snapshot
+    if topic_code not in snapshot.topics:
         # Shouldn't really ever happen, but ¯\_(ツ)_/¯
         await query.answer(MESSAGES['oops'])
         return
@@ -271,74 +357,130 @@ async def fsm_cb_query_get_topic(query: types.CallbackQuery, state: FSMContext):
     await Quiz.next()
     state_data = await state.get_data()
 
-    # Tell admin about quiz request
+    # The request is shown on the admin's dashboard, admin_msg_text is the
+    # summary sent to the admin along with the results
+    tg_info = oneline_tg_info(query.from_user)
     admit_text_admin = MESSAGES['admit_text_admin'].format(
-        f"{quizes.topics[topic_code]['name']} ({topic_code})",
+        f"{snapshot.topics[topic_code]['name']} ({topic_code})",
         state_data['user_info'],
-        oneline_tg_info(query.from_user),
+        tg_info,
     )
-    keyboard_markup = get_kb_admit(query.from_user.id, topic_code)
-    admin_msg = await bot.send_message(ADMIN, admit_text_admin, reply_markup=keyboard_markup)
+    admin = await route_admission(topic_code)
     await state.update_data({
-        'admin_msg_id': admin_msg.message_id,
-        'admin_msg_text': admin_msg.text,
+        'topic-code': topic_code,
+        'tg-info': tg_info,
+        'admission-requested': round(time.time()),
+        'admin_msg_text': admit_text_admin,
+        'admin': admin,
     })
-    dp.storage.write(dp.storage.path)
+    await persistence.mark_dirty()
+    await pending_changed(state.user, await state.get_data())
+    dashboard(admin).request_refresh()
 
     # Tell user to wait for admission
-    await state.update_data({'topic-code': topic_code})
-    admit_text_user = MESSAGES['admit_text_user'].format(quizes.topics[topic_code]['name'])
-    msg_sent = await bot.send_message(query.from_user.id, admit_text_user)
+    admit_text_user = snapshot.render(
+        ('admit-text-user', topic_code),
+        lambda: MESSAGES['admit_text_user'].format(snapshot.topics[topic_code]['name']),
+    )
+    msg_sent = await send_message(PRIORITY_USER, query.from_user.id, admit_text_user)
     await del_other_msgs(state, msg_sent.message_id)
     await query.answer()
 
 
-def get_query_answer(cb_data: str, correct_answer:str, show_correctness: bool, show_correct: bool):
+def get_query_answer(points: int, correct_answer:str, show_correctness: bool, show_correct: bool):
     '''Return text based on show_correctness (and answer if show_correctness is
     True) as well as show_alert flag for notification
     '''
     show_alert = False
     text = ''
     if show_correct:
-        if int(cb_data):
+        if points:
             text = MESSAGES['query_answer_correct']
         else:
             text = MESSAGES['query_answer_show_correct'].format(correct_answer)
             show_alert = True
     elif show_correctness:
-        if int(cb_data):
+        if points:
             text = MESSAGES['query_answer_correct']
         else:
             text = MESSAGES['query_answer_incorrect']
     return text, show_alert
 
 
-@dp.callback_query_handler(text=['0', '1'], state=Quiz.quiz)
+def answer_signer(chat_id, seed: int) -> AnswerSigner:
+    return AnswerSigner(ANSWER_KEY, chat_id, seed)
+
+
+@dp.callback_query_handler(regexp=ANSWER_PATTERN, state=Quiz.quiz)
 async def fsm_cb_query_answer(query: types.CallbackQuery, state: FSMContext):
-    mark = int(query.data)
+    data = await state.get_data()
+    seed = data.get('quiz-seed', 0)
+    answer = answer_signer(state.user, seed).verify(query.data)
+    if answer is None or answer[0] != data.get('q_id'):
+        # Forged, left from another quiz or the question is already answered
+        await query.answer(MESSAGES['oops'])
+        return
+    if data.get('deadline') and time.time() > data['deadline']:
+        # Answered too late, before the scheduler got to the deadline
+        await query.answer(MESSAGES['time_is_up'])
+        await time_is_up(state, data)
+        return
+    q_id, option = answer
+    # Correctness is resolved against the question the user was shown
+    snapshot = quiz_snapshot(data)
+    if snapshot is None:
+        await query.answer(MESSAGES['oops'])
+        await abort_quiz(state, data)
+        return
+    topic_code = data.get('topic-code')
+    if topic_code not in snapshot.topics:
+        await query.answer(MESSAGES['oops'])
+        return
+    topic = snapshot.topics[topic_code]
+    # Questions of adaptive topics are picked as the quiz goes
+    index = data['asked'][q_id] if topic['adaptive'] else None
+    question = get_question(snapshot, topic_code, q_id, seed, index)
+    if question is None:
+        await query.answer(MESSAGES['oops'])
+        await abort_quiz(state, data)
+        return
+    chosen = answer_order(question, seed, q_id)[option]
+    points = question.answers[chosen][1]
     await del_other_msgs(state)
     data = await state.get_data()
-    score = data.get('score', 0)
-    correct_answer = data.get('correct-answer')
-    show_correctness = data.get('show-correctness', False)
-    show_correct = data.get('show-correct', False)
-    if mark:
-        score += int(query.data)
-        await state.update_data({'score': score})
-        dp.storage.write(dp.storage.path)
+    score = data.get('score', 0) + points
+    # Indices of chosen answers within the question, 0 is the correct one
+    update = {'score': score, 'answers': data.get('answers', []) + [chosen]}
+    if topic['adaptive']:
+        update.update(adaptive_update(data, points))
+    await state.update_data(update)
+    await persistence.mark_dirty()
+    if results is not None:
+        # The question was shown when the message was sent or last edited
+        shown = query.message.edit_date or query.message.date
+        results.record(
+            ts=round(time.time(), 3),
+            user=state.user,
+            topic=topic_code,
+            version=snapshot.version,
+            seed=seed,
+            q_id=q_id,
+            question=question.key,
+            chosen=chosen,
+            points=points,
+            seconds=max(0, round(time.time() - shown.timestamp())),
+        )
+        await results_persistence.mark_dirty()
     result, q_id = await send_question(state, query.message.message_id)
-    query_answer, show_alert = get_query_answer(query.data, correct_answer, show_correctness, show_correct)
+    query_answer, show_alert = get_query_answer(points, question.correct_answer, topic['show-correctness'], topic['show-correct'])
     await query.answer(query_answer, show_alert=show_alert)
     if result is None:
         # If there were no more questions
         user_score = f'{score}/{q_id} = {round(score/q_id*100)}%'
-        admin_text_new = data.get('admin_msg_text') + f'\n\n{user_score}'
-        try:
-            await bot.edit_message_text(admin_text_new, ADMIN, data.get('admin_msg_id'))
-        # TODO Is there a specific error when message is too old to edit?
-        except:
-            await bot.send_message(ADMIN, str(user_score), reply_to_message_id=data.get('admin_msg_id'))
-        await query.message.delete()
+        if topic['adaptive']:
+            user_score += '\n' + MESSAGES['adaptive_level'].format(round(update['adaptive-level']*100))
+        await notify_admin(data, user_score)
+        cleaner.schedule(query.message.chat.id, [query.message.message_id])
 
 
 async def send_question(state: FSMContext, edit_msg=None):
@@ -349,42 +491,172 @@ async def send_question(state: FSMContext, edit_msg=None):
     if topic_code is None:
         print('Oops, topic-code is None!')
         return
-    text, keyboard_markup, parse_mode, correct_anwer = prepare_question(quizes, topic_code, q_id)
+    # Stick to the snapshot the quiz was started with even if /reload happened
+    snapshot = quizes.get(data.get('quiz-version'))
+    if topic_code not in snapshot.topics:
+        print(f'Oops, topic-code {topic_code} is not in quizes v{snapshot.version}!')
+        return
+    # The draw of questions is defined by the seed, so it is all we keep
+    seed = new_seed() if q_id == 0 else data.get('quiz-seed', 0)
+    topic = snapshot.topics[topic_code]
+    index = None
+    asked = data.get('asked', []) if q_id else []
+    if topic['adaptive'] and q_id < topic['q_count']:
+        if q_id and settled(data.get('adaptive-recent', []), q_id, topic['adaptive-tolerance'], topic['adaptive-min-questions']):
+            # The level is known well enough already
+            await finish_quiz(state, data, snapshot, q_id)
+            return None, q_id
+        level = data.get('adaptive-level', START_LEVEL) if q_id else START_LEVEL
+        index = difficulty.pick(snapshot, topic_code, level, asked, seed, q_id)
+    text, keyboard_markup, parse_mode = prepare_question(snapshot, topic_code, q_id, seed, answer_signer(state.user, seed), index)
     if text is None:
         # No more questions to ask
-        score = data.get('score', 0)
-        final_text = MESSAGES['test_ended'].format(
-            quizes.topics[topic_code]['name'],
-            q_id,
-            score,
-            round(score/q_id*100)
-        )
-        sent_msg = await bot.send_message(state.user, final_text)
-        await del_other_msgs(state, sent_msg.message_id)
-        data = clear_data(data)
-        await state.set_data(data)
-        await state.reset_state(with_data=False)
-        dp.storage.write(dp.storage.path)
+        await finish_quiz(state, data, snapshot, q_id)
         return None, q_id
+    now = time.time()
+    quiz_deadline = data.get('quiz-deadline')
+    if q_id == 0 and topic['quiz-time']:
+        quiz_deadline = round(now + topic['quiz-time'], 3)
+    question_deadline = round(now + topic['question-time'], 3) if topic['question-time'] else None
+    # The earliest of the two, the scheduler only keeps one per user
+    deadline = min(filter(None, (quiz_deadline, question_deadline)), default=None)
     if edit_msg:
-        await bot.edit_message_text(text, state.user, edit_msg, reply_markup=keyboard_markup, parse_mode=parse_mode)
+        await edit_message(PRIORITY_QUIZ, state.user, edit_msg, text, reply_markup=keyboard_markup, parse_mode=parse_mode)
     else:
-        question_message = await bot.send_message(state.user, text, reply_markup=keyboard_markup, parse_mode=parse_mode)
+        question_message = await send_message(PRIORITY_QUIZ, state.user, text, reply_markup=keyboard_markup, parse_mode=parse_mode)
         if q_id == 0:
             # The very first question has just been asked
             await state.update_data({
                 'qmessage_id': question_message.message_id,
-                'show-correctness': quizes.topics[topic_code]['show-correctness'],
-                'show-correct': quizes.topics[topic_code]['show-correct'],
+                'quiz-version': snapshot.version,
+                'quiz-seed': seed,
+                'quiz-deadline': quiz_deadline,
             })
-    await state.update_data({
-        'q_id': q_id,
-        'correct-answer': correct_anwer,
-    })
-    dp.storage.write(dp.storage.path)
+    update = {'q_id': q_id, 'deadline': deadline}
+    if index is not None:
+        update['asked'] = asked + [index]
+    await state.update_data(update)
+    await persistence.mark_dirty()
+    if deadline:
+        deadlines.schedule(str(state.user), deadline)
     return q_id, q_id
 
 
+async def finish_quiz(state: FSMContext, data: dict, snapshot, q_count: int, timed_out: bool = False) -> str:
+    '''Show the final score (out of q_count questions) to the user, clear
+    the quiz data and return the score line for the admin
+    '''
+    score = data.get('score', 0)
+    percent = round(score/q_count*100)
+    final_text = MESSAGES['test_ended'].format(
+        snapshot.topics[data['topic-code']]['name'],
+        q_count,
+        score,
+        percent
+    )
+    if timed_out:
+        final_text = f"{MESSAGES['time_is_up']}\n\n{final_text}"
+    if 'adaptive-level' in data:
+        final_text += '\n' + MESSAGES['adaptive_level'].format(round(data['adaptive-level']*100))
+    sent_msg = await send_message(PRIORITY_QUIZ, state.user, final_text)
+    await del_other_msgs(state, sent_msg.message_id)
+    deadlines.cancel(str(state.user))
+    # Re-read to keep the 'delete' list just updated
+    data = clear_data(await state.get_data())
+    await state.set_data(data)
+    await state.reset_state(with_data=False)
+    await persistence.mark_dirty()
+    return f'{score}/{q_count} = {percent}%'
+
+
+async def on_deadline(user_id, deadline: float):
+    '''Called by the scheduler when the user's deadline has come'''
+    async with dp.storage.lock(user_id):
+        state = FSMContext(dp.storage, user_id, user_id)
+        if await state.get_state() != Quiz.quiz.state:
+            return
+        data = await state.get_data()
+        if data.get('deadline') != deadline:
+            # Answered in time, the quiz was restarted, etc
+            return
+        await time_is_up(state, data)
+
+
+async def time_is_up(state: FSMContext, data: dict):
+    '''Move on to the next question if the question time is over, finish
+    the quiz with the partial score if the quiz time is (unanswered
+    questions get no points)
+    Call with the user's storage lock held
+    '''
+    snapshot = quiz_snapshot(data)
+    if snapshot is None:
+        await abort_quiz(state, data)
+        return
+    topic_code = data.get('topic-code')
+    if topic_code not in snapshot.topics:
+        print(f'Oops, topic-code {topic_code} is not in quizes v{snapshot.version}!')
+        return
+    topic = snapshot.topics[topic_code]
+    # None marks the question which was not answered
+    update = {'answers': data.get('answers', []) + [None]}
+    if topic['adaptive']:
+        update.update(adaptive_update(data, False))
+    await state.update_data(update)
+    quiz_deadline = data.get('quiz-deadline')
+    if quiz_deadline is None or data['deadline'] < quiz_deadline:
+        result, q_id = await send_question(state, data.get('qmessage_id'))
+        if result is not None:
+            return
+        score = data.get('score', 0)
+        user_score = f'{score}/{q_id} = {round(score/q_id*100)}%'
+    else:
+        user_score = await finish_quiz(state, dict(data, **update), snapshot, topic['q_count'], timed_out=True)
+        user_score = f"{user_score}\n{MESSAGES['test_timed_out']}"
+    if topic['adaptive']:
+        user_score += '\n' + MESSAGES['adaptive_level'].format(round(update['adaptive-level']*100))
+    await notify_admin(data, user_score)
+    cleaner.schedule(state.user, [data.get('qmessage_id')])
+
+
+def adaptive_update(data: dict, correct: bool) -> dict:
+    '''Return the level of an adaptive quiz after the answer to the current
+    question along with the recent levels (see adaptive.settled())
+    '''
+    level = next_level(data.get('adaptive-level', START_LEVEL), correct, data['q_id'] + 1)
+    return {
+        'adaptive-level': level,
+        'adaptive-recent': (data.get('adaptive-recent', []) + [level])[-STABLE_ANSWERS:],
+    }
+
+
+def quiz_snapshot(data: dict):
+    '''Return the snapshot the quiz was started with (the current one if it
+    has not started yet), None if it is not loaded: the file was changed
+    before a restart, or another bot process has reloaded it and this one
+    has not yet
+    '''
+    version = data.get('quiz-version')
+    return quizes.snapshot if version is None else quizes.snapshots.get(version)
+
+
+async def abort_quiz(state: FSMContext, data: dict):
+    '''End the quiz whose questions cannot be found, the user may request
+    it again
+    Call with the user's storage lock held
+    '''
+    print(f"Oops, quizes v{data.get('quiz-version')} of user {state.user} are not loaded, the quiz is dropped")
+    sent_msg = await send_message(PRIORITY_QUIZ, state.user, MESSAGES['test_outdated_user'])
+    await del_other_msgs(state, sent_msg.message_id)
+    deadlines.cancel(str(state.user))
+    if data.get('qmessage_id'):
+        cleaner.schedule(state.user, [data['qmessage_id']])
+    await notify_admin(data, MESSAGES['test_outdated_admin'])
+    data = clear_data(await state.get_data())
+    await state.set_data(data)
+    await state.reset_state(with_data=False)
+    await persistence.mark_dirty()
+
+
 def clear_data(data: dict):
     '''Clean up all the optional keys in data dictionary'''
     for key in [
@@ -392,154 +664,536 @@ def clear_data(data: dict):
             'admin_msg_id', 'admin_msg_text',
             'qmessage_id', 'show-correctness',
             'show-correct', 'correct-answer',
+            'quiz-version', 'quiz-seed', 'answers',
+            'tg-info', 'admission-requested', 'admin',
+            'deadline', 'quiz-deadline',
+            'asked', 'adaptive-level', 'adaptive-recent',
     ]:
         data.pop(key, None)
     return data
 
 
-def my_md(text: str, plaintext: bool = False) -> str:
-    '''Prepare text for Markdown by either removing 'MD:' prefix or
-    escaping some characters for Telegram Markdown
-    Setting plaintext to True returns plaintext (no MD formatting) version to
-    use in notifications showing the correct answer
+async def decide_admission(user_id, admit: bool, topic_code=None, current_chat_id=None):
+    '''Admit the user waiting for admission (to topic_code if it is given)
+    or turn them down
+    Return (True, new admin_msg_text) or (False, the problem description)
     '''
-    def clean_up(text: str) -> str:
-        result = ''
-        escaped = False
-        for i, letter in enumerate(text):
-            if not escaped and letter == '\\':
-                escaped = True
-                continue
-            if letter in special_characters:
-                if escaped:
-                    escaped = False
-                    result += letter
-            else:
-                result += letter
-        return result
-
-    special_characters = '_*[]()~`>#+-=|{}.!'
-    if text.startswith('MD:'):
-        result = text.replace('MD:', '', 1)
-        if plaintext:
-            return clean_up(result)
+    # The user's state is changed while processing admin's update
+    async with other_chat_lock(user_id, current_chat_id):
+        user_state = FSMContext(dp.storage, user_id, user_id)
+        cur_state = await user_state.get_state()
+        user_data = await user_state.get_data()
+        cur_user_topic = user_data.get('topic-code')
+
+        if cur_state != 'Quiz:get_admission':
+            # Should not be listed anymore
+            await pending_changed(user_id)
+            return False, f'User {user_id} state is set to {cur_state} instead of Quiz:get_admission'
+
+        if topic_code is not None and cur_user_topic != topic_code:
+            return False, f'User {user_id} topic-code is set to {cur_user_topic} instead of requested {topic_code}'
+
+        if admit:
+            decision = MESSAGES['admit_yes_admin']
+            snapshot = quizes.snapshot
+            admit_text = snapshot.render(
+                ('admit-yes-user', cur_user_topic),
+                lambda: admit_yes_text(snapshot.topics.get(cur_user_topic)),
+            )
+            sent_message = await send_message(PRIORITY_USER, user_id, admit_text)
+            await user_state.set_state(Quiz.quiz)
+            await send_question(user_state)
         else:
-            return result
-    elif plaintext:
-        # Do not escape anything - text is already plaintext
-        return text
-    result = text
-    for letter in special_characters:
-        result = result.replace(letter, f'\{letter}')
-    return result
+            decision = MESSAGES['admit_no_admin']
+            sent_message = await send_message(PRIORITY_USER, user_id, MESSAGES['admit_no_user'])
+            await user_state.reset_state(with_data=False)
+        await pending_changed(user_id)
+
+        await del_other_msgs(user_state, sent_message.message_id)
+        # The last line of the admission text asks for the decision
+        new_text = '\n'.join(user_data.get('admin_msg_text', '').split('\n')[:-1] + [decision])
+        await user_state.update_data({'admin_msg_text': new_text})
+        await persistence.mark_dirty()
+        return True, new_text
+
+
+def admit_yes_text(topic) -> str:
+    '''Return the admission message for the topic (None if it is gone)'''
+    text = MESSAGES['admit_yes_user']
+    if topic and (topic['question-time'] or topic['quiz-time']):
+        text += '\n\n' + MESSAGES['time_limits'].format(topic['question-time'] or '-', topic['quiz-time'] or '-')
+    return text
+
+
+async def notify_admin(data: dict, text: str):
+    '''Tell the user's admin about their quiz (result, cancellation): edit
+    the admission message of quizes requested before the dashboard, add the
+    admission summary and text to the admin's digest otherwise
+    '''
+    admin = user_admin(data)
+    admin_text_new = data.get('admin_msg_text', '') + f'\n\n{text}'
+    if data.get('admin_msg_id'):
+        try:
+            await edit_message(PRIORITY_ADMIN, admin, data['admin_msg_id'], admin_text_new)
+            return
+        except Exception:
+            pass
+    admin_digest(admin).add(admin_text_new)
 
 
-def format_answer(use_md, letter, answer):
-    '''Prepare answer line based on use_md:
+def user_admin(data: dict):
+    '''Return chat id of the admin handling the user's admission'''
+    # Quizes requested before admin routing went to the only admin
+    return data.get('admin', ADMINS[0])
 
-    use_md == False
-    - `Answer-A text`     ->  A. `Answer-A text`
 
-    use_md == True
-    - `Answer-A text`     ->  A\. \`Answer\-A text\`
-    - MD:`Answer-B text`  ->  B\. `Answer-B text`
-    '''
-    result = letter + ('\\' if use_md else '') + '. '
-    result += my_md(answer) if use_md else answer
-    return result
+def is_admin(chat_id) -> bool:
+    '''Global admins and admins of any topic'''
+    return chat_id in ADMINS or any(chat_id in topic['admins'] for topic in quizes.topics.values())
 
 
-def prepare_question(quizes, topic_code, q_id):
-    '''Return a tuple of q+rnd(asnwers), inline_kb(('A',0), ('B',1), ('C',0)),
-    parse_mode (either 'MarkdownV2' or '') and the correct_answer
-    or (None, None, None, None) if there are no more questions
+async def route_admission(topic_code: str):
+    '''Choose the admin for an admission request: one of the topic's
+    admins (the global ones if the topic has none) who are not away
     '''
-    from random import sample
-    letters = 'ABCDEFGHIJ'
-    topic = quizes.topics[topic_code]
-    if q_id > topic['q_count'] - 1:
-        return (None, None, None, None)
-    top_question = quizes.questions[topic['q_indices'][q_id]]
-    final_q = top_question['q']
-    raw_answers = list(map(str, top_question['a']))
-    correct_answer = raw_answers[0]
-    # use_md will be True if question or any answer startswith 'MD:', False otherwise
-    use_md = final_q.startswith('MD:') or any(
-        map(lambda s: s.startswith('MD:'), raw_answers))
-    if use_md:
-        final_q = my_md(final_q)
-    # Prepare answers as [('Correct', 1), ('Incorrect', 0)] and shuffle them
-    random_answers = sample([(a, int(a == correct_answer))
-                            for a in raw_answers], len(raw_answers))
-    buttons = []
-    for i, (answer, points) in enumerate(random_answers):
-        delimiter = '\n' if i else '\n\n'  # Extra newline right after the question
-        final_q += delimiter + format_answer(use_md, letters[i], answer)
-        buttons.append(types.InlineKeyboardButton(
-            letters[i], callback_data=str(points)))
-    keyboard_markup = types.InlineKeyboardMarkup()
-    keyboard_markup.row(*buttons)
-    parse_mode = 'MarkdownV2' if use_md else ''
-    return (final_q, keyboard_markup, parse_mode, my_md(correct_answer, plaintext=True))
+    candidates = quizes.topics[topic_code]['admins'] or ADMINS
+    available = []
+    for admin in candidates:
+        admin_data = await dp.storage.get_data(chat=admin, user=admin)
+        if not admin_data.get('away'):
+            available.append(admin)
+    # Everybody is away, the request should go somewhere anyway
+    return admin_router.choose(available or candidates, pending.counts())
+
+
+@dp.message_handler(commands=['away', 'back'])
+async def cmd_away(msg: types.Message, state: FSMContext):
+    '''Stop or resume routing admission requests to the admin'''
+    if is_admin(msg.chat.id):
+        away = msg.get_command(pure=True) == 'away'
+        await state.update_data({'away': away})
+        await persistence.mark_dirty()
+        await send_message(PRIORITY_ADMIN, msg.chat.id, 'Away' if away else 'Back')
+    cleaner.schedule(msg.chat.id, [msg.message_id])
 
 
 @dp.callback_query_handler(text_startswith=['admit_', 'noadmit_'])
 async def cb_query_admit(query: types.CallbackQuery):
-    if query.message.chat.id != ADMIN:
+    '''Decision on an admission message sent before the dashboard'''
+    if not is_admin(query.message.chat.id):
         await query.answer(MESSAGES['oops'])
         return
 
     admit, user_id, topic_code = query.data.split('_', 2)
-    user_state = FSMContext(dp.storage, user_id, user_id)
-    cur_state = await user_state.get_state()
-    user_data = await user_state.get_data()
-    cur_user_topic = user_data.get('topic-code')
-
-    if cur_state != 'Quiz:get_admission':
+    if admit not in ('admit', 'noadmit'):
         await query.answer(MESSAGES['oops'])
-        text = f'User state is set to {cur_state} instead of Quiz:get_admission'
-        await query.message.answer(text)
         return
-
-    if cur_user_topic != topic_code:
+    ok, text = await decide_admission(user_id, admit == 'admit', topic_code, query.message.chat.id)
+    if not ok:
         await query.answer(MESSAGES['oops'])
-        text = f'User topic-code is set to {cur_user_topic} instead of requested {topic_code}'
-        await query.message.answer(text)
+        await send_message(PRIORITY_ADMIN, query.message.chat.id, text)
         return
+    await query.answer('Admit' if admit == 'admit' else 'No admit')
+    await edit_message(PRIORITY_ADMIN, query.message.chat.id, query.message.message_id, text)
+    dashboard(query.message.chat.id).request_refresh()
+
+
+def pending_user(user_id, data: dict) -> PendingUser:
+    return PendingUser(
+        int(user_id),
+        data.get('topic-code'),
+        data.get('user_info', ''),
+        data.get('tg-info', ''),
+        data.get('admission-requested', 0),
+        user_admin(data),
+    )
 
-    if admit == 'noadmit':
-        await query.answer('No admit')
-        decision = MESSAGES['admit_no_admin']
-        sent_message = await bot.send_message(user_id, MESSAGES['admit_no_user'])
-        await user_state.reset_state(with_data=False)
-    elif admit == 'admit':
-        await query.answer('Admit')
-        decision = MESSAGES['admit_yes_admin']
-        sent_message = await bot.send_message(user_id, MESSAGES['admit_yes_user'])
-        await user_state.set_state(Quiz.quiz)
-        await send_question(user_state)
+
+async def pending_changed(user_id, data: dict = None):
+    '''Add the user (with data of the admission request) to the pending
+    index, or drop them from it if data is None
+    Other bot processes are told as well, call with the user's lock held so
+    that they get the changes in order
+    '''
+    if data is None:
+        pending.discard(int(user_id))
     else:
+        pending.add(pending_user(user_id, data))
+    if isinstance(storage, RedisStorage):
+        message = {'user': int(user_id), 'pending': None if data is None else pending_user(user_id, data)}
+        await storage.publish('pending', json.dumps(message, ensure_ascii=False))
+
+
+async def on_pending_published(message: str):
+    '''Another bot process has changed the pending index, refresh the
+    dashboards which show the user
+    '''
+    await ready.wait()
+    message = json.loads(message)
+    before = pending.users.get(message['user'])
+    if message['pending'] is None:
+        pending.discard(message['user'])
+    else:
+        pending.add(PendingUser(*message['pending']))
+    after = pending.users.get(message['user'])
+    for admin in {p.admin for p in (before, after) if p is not None}:
+        dashboard(admin).request_refresh()
+
+
+async def rebuild_pending():
+    '''Fill the pending index from the storage (full scan, on startup and
+    after session GC to catch up with anything missed)
+    '''
+    pending.begin_rebuild()
+    users = []
+    async for chat, user, record in dp.storage.records():
+        if record.get('state') == Quiz.get_admission.state:
+            users.append(pending_user(user, record['data']))
+    pending.replace(users)
+
+
+async def render_dashboard(chat_id, page: int, selected: set):
+    waiting = pending.of_admin(chat_id)
+    text, keyboard, page = admissions.render(waiting, quizes.topics, MESSAGES, page, selected)
+    return text, keyboard, page, len(waiting)
+
+
+async def send_dashboard(chat_id, text: str, keyboard):
+    return await send_message(PRIORITY_ADMIN, chat_id, text, reply_markup=keyboard)
+
+
+async def edit_dashboard(chat_id, msg_id, text: str, keyboard):
+    return await edit_message(PRIORITY_ADMIN, chat_id, msg_id, text, reply_markup=keyboard)
+
+
+def dashboard(chat_id) -> Dashboard:
+    '''Return admission dashboard of the admin chat'''
+    if chat_id not in dashboards:
+        dashboards[chat_id] = Dashboard(
+            chat_id, render_dashboard, send_dashboard, edit_dashboard, cleaner, dp.storage, persistence.mark_dirty,
+        )
+    return dashboards[chat_id]
+
+
+@dp.message_handler(commands=['admissions'])
+async def cmd_admissions(msg: types.Message):
+    '''Show the admission dashboard to the admin in a new message'''
+    if is_admin(msg.chat.id):
+        await dashboard(msg.chat.id).refresh(new_message=True, current_chat_id=msg.chat.id)
+    cleaner.schedule(msg.chat.id, [msg.message_id])
+
+
+@dp.callback_query_handler(text_startswith=['dsel_', 'dpage_'], state='*')
+async def cb_query_dashboard(query: types.CallbackQuery):
+    '''Select a user or turn the page of the dashboard'''
+    if not is_admin(query.message.chat.id):
         await query.answer(MESSAGES['oops'])
         return
+    board = dashboard(query.message.chat.id)
+    state = await board.get_state()
+    action, value = query.data.split('_', 1)
+    if action == 'dsel':
+        state['selected'] ^= {int(value)}
+    else:
+        state['page'] = int(value)
+    state['message'] = query.message.message_id
+    await board.set_state(state)
+    await board.refresh(current_chat_id=query.message.chat.id)
+    await query.answer()
 
-    await del_other_msgs(user_state, sent_message.message_id)
-    new_text = '\n'.join(query.message.text.split('\n')[:-1] + [decision])
-    await query.message.edit_text(new_text)
-    await user_state.update_data({'admin_msg_text': new_text})
-    dp.storage.write(dp.storage.path)
+
+@dp.callback_query_handler(text_startswith=['dall_'], state='*')
+@dp.callback_query_handler(text=['dadm', 'drej'], state='*')
+async def cb_query_dashboard_decide(query: types.CallbackQuery):
+    '''Admit all users waiting for a topic, admit or turn down the
+    selected users
+    The user's lock makes the first decision win, the others find the user
+    is not waiting anymore
+    '''
+    if not is_admin(query.message.chat.id):
+        await query.answer(MESSAGES['oops'])
+        return
+    board = dashboard(query.message.chat.id)
+    state = await board.get_state()
+    if query.data.startswith('dall_'):
+        topic_code = query.data.split('_', 1)[1]
+        user_ids = [p.user_id for p in pending.of_admin(query.message.chat.id) if p.topic_code == topic_code]
+        admit = True
+    else:
+        user_ids = sorted(state['selected'])
+        admit = query.data == 'dadm'
+        state['selected'] = set()
+    state['message'] = query.message.message_id
+    await board.set_state(state)
+    await query.answer(f"{'Admit' if admit else 'No admit'}: {len(user_ids)}")
+    # Users are notified and get their first questions concurrently
+    outcomes = await fan_out(
+        lambda user_id: decide_admission(user_id, admit, current_chat_id=query.message.chat.id),
+        user_ids,
+        ADMISSION_CONCURRENCY,
+    )
+    problems = []
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException):
+            problems.append(repr(outcome))
+        elif not outcome[0]:
+            problems.append(outcome[1])
+    await board.refresh(current_chat_id=query.message.chat.id)
+    if problems:
+        text = f'{len(problems)} of {len(user_ids)} users were not processed:\n' + '\n'.join(problems[:10])
+        await send_message(PRIORITY_ADMIN, query.message.chat.id, text)
 
 
 @dp.message_handler(state='*', content_types=types.ContentType.ANY)
 async def any_message(msg: types.Message):
     '''Delete any unexpected messages'''
     if msg.text:
-        if msg.text.startswith('/reload@'):
+        if msg.text.startswith(('/reload@', '/stats@', '/qstats@', '/admissions@', '/away@', '/back@')):
             return
-    await msg.delete()
+    cleaner.schedule(msg.chat.id, [msg.message_id])
 
 
-ADMIN = config.admin
-MESSAGES = load_yaml(config.messages_filename)
-assert MESSAGES is not None, f'Check that there is a correct {config.messages_filename}'
-quizes = Quizes(config.quizes_filename)
-executor.start_polling(dp)#, skip_updates=True)
+# Global admins, the first one also gets admissions requested before routing
+ADMINS = tuple(getattr(config, 'admins', None) or [config.admin])
+ADMISSION_CONCURRENCY = getattr(config, 'admission_concurrency', 10)
+admin_router = AdminRouter(getattr(config, 'admin_routing', 'round-robin'))
+dashboards = {}
+pending = PendingIndex()
+admin_digests = {}
+
+
+def admin_digest(chat_id) -> Digest:
+    if chat_id not in admin_digests:
+        admin_digests[chat_id] = Digest(
+            chat_id,
+            functools.partial(send_message, PRIORITY_ADMIN),
+            delay=getattr(config, 'admin_digest_interval', 5.0),
+        )
+    return admin_digests[chat_id]
+
+
+deadlines = DeadlineScheduler(on_deadline)
+difficulty = DifficultyIndex()
+
+
+def refresh_difficulty():
+    '''Order questions of adaptive topics by the answers logged so far
+    (blocking, run in a worker thread)
+    '''
+    difficulty.refresh(list(quizes.snapshots.values()), results.stats if results is not None else {})
+
+
+ANSWER_KEY = derive_key(getattr(config, 'callback_secret', None) or config.token)
+# Number of {} fields of the templates, the other messages are sent as is
+MESSAGE_FIELDS = {
+    'admit_text_admin': 3,
+    'admit_text_user': 1,
+    'dashboard_title': 1,
+    'dashboard_admit_all': 2,
+    'dashboard_admit_selected': 1,
+    'dashboard_reject_selected': 1,
+    'query_answer_show_correct': 1,
+    'test_ended': 4,
+    'time_limits': 2,
+    'adaptive_level': 1,
+}
+
+
+def load_messages(filename) -> dict:
+    '''Load messages and check them, so a broken template or a too long
+    message is found on startup rather than when it is sent
+    '''
+    messages = load_yaml(filename)
+    assert messages is not None, f'Check that there is a correct {filename}'
+    for key, fields in MESSAGE_FIELDS.items():
+        found = sum(field is not None for _, field, _, _ in string.Formatter().parse(messages.get(key, '')))
+        assert found == fields, f'{filename}: {key} should have {fields} {{}} fields, found {found}'
+    for key, text in messages.items():
+        if isinstance(text, str):
+            assert utf16_length(text) <= MESSAGE_LIMIT, f'{filename}: {key} is longer than {MESSAGE_LIMIT} characters'
+    return messages
+
+
+MESSAGES = load_messages(config.messages_filename)
+quizes = Quizes(
+    config.quizes_filename,
+    getattr(config, 'quizes_cache_filename', None),
+    getattr(config, 'quizes_hot_questions', HOT_QUESTIONS),
+    load=False,
+)
+
+
+async def refresh_metrics():
+    '''Update gauges which are too expensive to keep up to date on every
+    update
+    '''
+    active = {}
+    async for chat, user, record in dp.storage.records():
+        if record.get('state') == 'Quiz:quiz':
+            topic = (record['data'].get('topic-code'),)
+            active[topic] = active.get(topic, 0) + 1
+    ACTIVE_QUIZES.replace(active)
+    stats = outbound.stats()
+    for name in PRIORITY_NAMES.values():
+        QUEUE_DEPTH.set(f'outbound-{name}', value=stats[name]['queued'])
+    QUEUE_DEPTH.set('outbound-in-flight', value=stats['in_flight'])
+    QUEUE_DEPTH.set('storage-pending', value=persistence.pending)
+    QUEUE_DEPTH.set('cleanup-tasks', value=cleaner.pending)
+
+
+async def report_metrics(interval: float):
+    '''Refresh gauges and print metrics summary every interval seconds'''
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh_metrics()
+            print(metrics.summary())
+        except Exception as e:
+            print(f'Oops, metrics report failed: {e!r}')
+
+
+async def restore_deadlines():
+    '''Schedule deadlines of the quizes in progress saved in the storage
+    (those passed while the bot was down are processed right away)
+    '''
+    async for chat, user, record in dp.storage.records():
+        deadline = record['data'].get('deadline')
+        if record.get('state') == Quiz.quiz.state and deadline:
+            deadlines.schedule(str(user), deadline)
+
+
+async def on_session_evicted(chat, user, record: dict):
+    if record['state'] == Quiz.get_admission.state:
+        await pending_changed(user)
+        dashboard(user_admin(record['data'])).request_refresh()
+    elif record['state'] == Quiz.quiz.state:
+        deadlines.cancel(str(user))
+
+
+session_gc = SessionGC(
+    storage,
+    ttl=getattr(config, 'session_ttl', None),
+    archive_path=getattr(config, 'session_archive_filename', None),
+    resolution=activity.resolution,
+    on_evict=on_session_evicted,
+)
+
+
+async def collect_sessions(interval: float):
+    '''Drop idle sessions every interval seconds'''
+    while True:
+        try:
+            report = await session_gc.collect()
+            if report['evicted'] or report['trimmed'] or report['stamped']:
+                await persistence.mark_dirty()
+            await rebuild_pending()
+            activity.prune()
+            print(gc_report(report))
+        except Exception as e:
+            print(f'Oops, session GC failed: {e!r}')
+        await asyncio.sleep(interval)
+
+
+def timed(name: str, func):
+    '''Return a function calling func and recording its time in profile'''
+    def run():
+        with profile.step(name):
+            func()
+    return run
+
+
+async def prepare():
+    '''Load everything handlers need (files are read in worker threads)
+    and let updates through
+    '''
+    try:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, timed('storage', storage.load))
+        loaded.add('storage')
+        await loop.run_in_executor(None, timed('quizes', quizes.load))
+        if results is not None:
+            await loop.run_in_executor(None, timed('result log', results.load))
+            loaded.add('result log')
+        with profile.step('deadlines'):
+            await restore_deadlines()
+        with profile.step('pending'):
+            await rebuild_pending()
+        await loop.run_in_executor(None, timed('difficulty', refresh_difficulty))
+    except Exception as e:
+        # Nothing can be processed without these
+        message = f'Oops, startup failed: {e!r}'
+        if not LAZY_STARTUP:
+            raise SystemExit(message)
+        # Polling is on already, shut down the way SIGTERM does it (see
+        # stop_on_signals(), aiohttp handles it in webhook mode)
+        print(message)
+        dp['startup-failed'] = True
+        signal.raise_signal(signal.SIGTERM)
+        return
+    ready.set()
+    profile.since_start('ready')
+    if PROFILE_STARTUP:
+        print(profile.report())
+    asyncio.ensure_future(collect_sessions(getattr(config, 'session_gc_interval', 3600)))
+
+
+def stop_on_signals():
+    '''Stop polling on SIGINT and SIGTERM, so that the bot shuts down
+    gracefully (otherwise KeyboardInterrupt is raised within whatever task is
+    running, which may leave e.g. outbound requests unsent forever, and
+    SIGTERM kills the bot without flushing the storage)
+    '''
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            # Not supported on Windows
+            loop.add_signal_handler(signum, loop.stop)
+
+
+async def on_startup(dp: Dispatcher):
+    profile.mark('setup')
+    if getattr(config, 'run_mode', 'polling') == 'polling':
+        stop_on_signals()
+    dp['preparing'] = asyncio.ensure_future(prepare())
+    if not LAZY_STARTUP:
+        await dp['preparing']
+    if isinstance(storage, RedisStorage):
+        storage.subscribe('quizes', on_quizes_published)
+        storage.subscribe('pending', on_pending_published)
+    if getattr(config, 'metrics_port', None):
+        dp['metrics_runner'] = await metrics.start_server(getattr(config, 'metrics_host', '127.0.0.1'), config.metrics_port)
+    asyncio.ensure_future(report_metrics(getattr(config, 'metrics_interval', 60)))
+
+
+async def on_shutdown(dp: Dispatcher):
+    # Flushing a storage which is not loaded yet would lose its file
+    await asyncio.wait([dp['preparing']])
+    await deadlines.close()
+    for digest in admin_digests.values():
+        await digest.close()
+    await cleaner.close()
+    await outbound.close()
+    if 'storage' in loaded:
+        await persistence.close()
+    if 'result log' in loaded:
+        await results_persistence.close()
+        results.close()
+    if dp.get('metrics_runner'):
+        await dp['metrics_runner'].cleanup()
+
+
+if getattr(config, 'run_mode', 'polling') == 'webhook':
+    app = webhook.make_app(
+        dp,
+        config.webhook_path,
+        secret=getattr(config, 'webhook_secret', ''),
+        url=getattr(config, 'webhook_url', None),
+        on_startup=on_startup,
+        on_shutdown=on_shutdown,
+        loaded=ready,
+    )
+    web.run_app(app, host=config.webhook_host, port=config.webhook_port)
+else:
+    executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)#, skip_updates=True)
+if dp.get('startup-failed'):
+    sys.exit(1)
@@ -0,0 +1,48 @@
+import base64
+import hashlib
+import hmac
+import re
+
+
+# a<q_id>.<option>.<signature>, e.g. 'a12.3.AbCdEfGhIjK' (the limit is 64 bytes)
+ANSWER_PATTERN = r'^a(\d+)\.(\d)\.([A-Za-z0-9_-]{11})$'
+ANSWER_RE = re.compile(ANSWER_PATTERN)
+SIGNATURE_BYTES = 8
+
+
+def derive_key(secret: str) -> bytes:
+    '''Return the key for AnswerSigner derived from a configured secret'''
+    return hashlib.sha256(b'quiz-bot answers:' + secret.encode()).digest()
+
+
+class AnswerSigner:
+    '''Make and check callback data of answer buttons
+
+    The signature covers the chat, the quiz (its seed), the question
+    position and the chosen option, so users can neither forge the data
+    (e.g. with a custom client) nor press buttons left from another quiz
+    Correctness is not in the data, it is resolved from the question
+    '''
+    __slots__ = ('key', 'session')
+
+    def __init__(self, key: bytes, chat_id, seed: int):
+        self.key = key
+        self.session = f'{chat_id}:{seed}'
+
+    def signature(self, q_id: int, option: int) -> str:
+        message = f'{self.session}:{q_id}:{option}'.encode()
+        digest = hmac.new(self.key, message, hashlib.sha256).digest()[:SIGNATURE_BYTES]
+        return base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+    def sign(self, q_id: int, option: int) -> str:
+        return f'a{q_id}.{option}.{self.signature(q_id, option)}'
+
+    def verify(self, data: str):
+        '''Return (q_id, option) if data was made by sign(), None otherwise'''
+        match = ANSWER_RE.match(data)
+        if match is None:
+            return None
+        q_id, option = int(match[1]), int(match[2])
+        if not hmac.compare_digest(match[3], self.signature(q_id, option)):
+            return None
+        return q_id, option
@@ -0,0 +1,112 @@
+import asyncio
+import json
+
+from aiogram import Bot
+from aiogram.utils import exceptions
+
+from outbound import PRIORITY_CLEANUP
+
+
+# The message is gone or will never be deletable (e.g. older than 48 hours),
+# there is no point in trying again
+GONE_ERRORS = (
+    exceptions.MessageToDeleteNotFound,
+    exceptions.MessageCantBeDeleted,
+    exceptions.MessageIdInvalid,
+    exceptions.ChatNotFound,
+    exceptions.BotBlocked,
+)
+# Bot API limit for deleteMessages
+BULK_LIMIT = 100
+
+
+class MessageCleaner:
+    '''Delete messages in the background
+
+    Several messages of a chat are deleted with a single deleteMessages call
+    (falls back to concurrent deleteMessage calls if the Bot API server does
+    not know the method), no more than concurrency requests are in flight
+    Requests go through outbound (OutboundScheduler) with the lowest
+    priority if it is given
+    '''
+
+    def __init__(self, bot: Bot, concurrency: int = 10, bulk: bool = True, outbound=None):
+        self.bot = bot
+        self.bulk = bulk
+        self.outbound = outbound
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+
+    def schedule(self, chat_id, msg_ids, on_retry=None):
+        '''Start deleting msg_ids without waiting for the result
+        on_retry(msg_ids) coroutine is awaited with the messages which could
+        not be deleted for now (flood control, network errors)
+        '''
+        task = asyncio.ensure_future(self._run(chat_id, list(msg_ids), on_retry))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    async def _run(self, chat_id, msg_ids, on_retry):
+        try:
+            retry = await self.delete(chat_id, msg_ids)
+            if retry and on_retry is not None:
+                await on_retry(retry)
+        except Exception as e:
+            print(f'Oops, cleanup of {msg_ids} in {chat_id} failed: {e!r}')
+
+    async def delete(self, chat_id, msg_ids) -> list:
+        '''Delete messages, return ids worth retrying later'''
+        if self.bulk and len(msg_ids) > 1:
+            retry = []
+            for i in range(0, len(msg_ids), BULK_LIMIT):
+                retry += await self._delete_bulk(chat_id, msg_ids[i:i + BULK_LIMIT])
+            return retry
+        results = await asyncio.gather(*(self._delete_one(chat_id, msg_id) for msg_id in msg_ids))
+        return [msg_id for msg_id in results if msg_id is not None]
+
+    async def _delete_bulk(self, chat_id, msg_ids) -> list:
+        try:
+            async with self._semaphore:
+                # Messages that cannot be deleted are silently skipped
+                await self._call(chat_id, self.bot.request, 'deleteMessages', {
+                    'chat_id': chat_id,
+                    'message_ids': json.dumps(msg_ids),
+                })
+        except GONE_ERRORS:
+            pass
+        except (exceptions.RetryAfter, exceptions.NetworkError):
+            return msg_ids
+        except exceptions.NotFound as e:
+            print(f'Oops, deleteMessages is not supported ({e!r}), deleting one by one')
+            self.bulk = False
+            return await self.delete(chat_id, msg_ids)
+        except exceptions.TelegramAPIError as e:
+            print(f'Oops, messages {msg_ids} in {chat_id} were not deleted: {e!r}')
+        return []
+
+    async def _delete_one(self, chat_id, msg_id):
+        '''Return msg_id if it is worth retrying, None otherwise'''
+        try:
+            async with self._semaphore:
+                await self._call(chat_id, self.bot.delete_message, chat_id, msg_id)
+        except GONE_ERRORS:
+            pass
+        except (exceptions.RetryAfter, exceptions.NetworkError):
+            return msg_id
+        except exceptions.TelegramAPIError as e:
+            print(f'Oops, message {msg_id} in {chat_id} was not deleted: {e!r}')
+        return None
+
+    async def _call(self, chat_id, method, *args):
+        if self.outbound is None:
+            return await method(*args)
+        return await self.outbound.run(PRIORITY_CLEANUP, chat_id, method, *args)
+
+    async def close(self):
+        '''Wait for scheduled deletions, call on shutdown'''
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
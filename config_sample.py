@@ -1,5 +1,37 @@
 token = '1234567890:ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghi'
+api_server = None  # e.g. 'http://localhost:8081' for a local Bot API server
 storage_filename = 'fsm_storage.json'
+storage_type = 'wal'  # 'json' rewrites the whole file on every write, 'redis' is shared by several bot processes
+redis_url = 'redis://localhost:6379/0'  # used by storage_type = 'redis'
+redis_prefix = 'quiz-bot'
+flush_mode = 'interval'  # 'always', 'interval' or 'exit'
+flush_interval = 1.0  # seconds
+flush_batch_size = 100
+delete_concurrency = 10  # max parallel message deletions
+session_ttl = 30 * 24 * 3600  # seconds, sessions idle for longer are dropped (None keeps them forever)
+session_archive_filename = 'sessions_archive.jsonl'  # dropped sessions are appended there, None just drops them
+session_gc_interval = 3600  # seconds between passes over the storage
+rate_limit_global = 30  # requests per second to Telegram
+rate_limit_chat = 1  # requests per second to a single chat
+rate_limit_chat_burst = 3  # requests to a single chat sent at once
 messages_filename = 'messages.yaml'
 quizes_filename = 'quizes.yaml'
-admin = 123456789
+quizes_cache_filename = 'quizes.cache'  # questions are read from there lazily, None disables the cache and keeps all of them in memory
+quizes_hot_questions = 1024  # questions read from the cache kept in memory
+results_filename = 'results.jsonl'  # every answer is logged there, None disables the log and /qstats
+results_rotate_bytes = 64 * 2**20
+admins = [123456789]  # chat ids of global admins (a single 'admin = 123456789' works as well)
+admin_routing = 'round-robin'  # or 'least-pending'
+admission_concurrency = 10  # users admitted at once from the admission dashboard
+admin_digest_interval = 5.0  # seconds, results and cancellations are sent to admin together
+run_mode = 'polling'  # or 'webhook'
+lazy_startup = True  # start polling at once, updates wait until the storage and quizes are loaded
+webhook_host = '127.0.0.1'  # address to listen on
+webhook_port = 8080
+webhook_path = '/webhook'
+webhook_url = 'https://example.com/webhook'  # None to skip setWebhook on startup
+webhook_secret = 'change-me'  # sent by Telegram in X-Telegram-Bot-Api-Secret-Token
+metrics_host = '127.0.0.1'
+metrics_port = 9090  # Prometheus metrics on GET /metrics, None to disable
+metrics_interval = 60  # seconds between metrics summaries in the log
+callback_secret = None  # signs answer buttons, defaults to token
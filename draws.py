@@ -0,0 +1,133 @@
+import bisect
+import hashlib
+import random
+
+
+MASK64 = (1 << 64) - 1
+FEISTEL_ROUNDS = 6
+
+
+def mix64(x: int) -> int:
+    '''splitmix64 finalizer, a cheap well-mixing function of 64-bit integers
+    (unlike hash() it is the same for every Python version and process)
+    '''
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+
+def new_seed() -> int:
+    '''Return a seed for a new draw (fits into JSON numbers of any parser)'''
+    return random.getrandbits(52)
+
+
+class Permutation:
+    '''Pseudorandom permutation of range(size) defined by seed
+
+    Any element is computed in O(1) without materializing the whole
+    permutation: a Feistel network permutes the smallest power-of-4 range
+    covering size, values outside of range(size) are permuted again until
+    they fit (less than 4 rounds on average)
+    '''
+    __slots__ = ('size', 'half_bits', 'mask', 'keys')
+
+    def __init__(self, size: int, seed: int):
+        half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+        digest = hashlib.blake2b(str(seed).encode(), digest_size=8 * FEISTEL_ROUNDS).digest()
+        self.size = size
+        self.half_bits = half_bits
+        self.mask = (1 << half_bits) - 1
+        self.keys = tuple(int.from_bytes(digest[i:i + 8], 'little') for i in range(0, len(digest), 8))
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index: int) -> int:
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        while True:
+            index = self._encrypt(index)
+            if index < self.size:
+                return index
+
+    def _encrypt(self, x: int) -> int:
+        mask = self.mask
+        left, right = x >> self.half_bits, x & mask
+        for key in self.keys:
+            left, right = right, left ^ (mix64(right ^ key) & mask)
+        return (left << self.half_bits) | right
+
+
+class DrawPlan:
+    '''How questions of a topic are drawn for a quiz (immutable)
+
+    Topic questions are split into strata (a single one unless the topic is
+    stratified), counts[i] questions are taken from strata[i] (a sequence of
+    question indices, e.g. a tuple or an array of a QuestionBank). A draw is
+    defined by a seed alone, position-th question of the draw is found in
+    O(1) (well, O(log len(strata))), so users' state only keeps the seed
+    and the position
+    '''
+    __slots__ = ('strata', 'counts', 'offsets', 'q_count')
+
+    def __init__(self, strata, sample=None):
+        strata = tuple(stratum for stratum in strata if len(stratum))
+        total = sum(map(len, strata))
+        q_count = total if sample is None else min(sample, total)
+        counts = allocate(q_count, tuple(map(len, strata)))
+        offsets = [0]
+        for count in counts[:-1]:
+            offsets.append(offsets[-1] + count)
+        object.__setattr__(self, 'strata', strata)
+        object.__setattr__(self, 'counts', counts)
+        object.__setattr__(self, 'offsets', tuple(offsets))
+        object.__setattr__(self, 'q_count', q_count)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('DrawPlan is immutable')
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
+    def question_index(self, seed: int, position: int) -> int:
+        '''Return index (within snapshot questions) of the position-th
+        question of the draw defined by seed
+        '''
+        if not 0 <= position < self.q_count:
+            raise IndexError(position)
+        slot = position
+        if len(self.strata) > 1:
+            # Interleave strata instead of asking them one after another
+            slot = Permutation(self.q_count, seed)[position]
+        stratum_id = bisect.bisect_right(self.offsets, slot) - 1
+        stratum = self.strata[stratum_id]
+        rank = Permutation(len(stratum), mix64(seed + stratum_id + 1))[slot - self.offsets[stratum_id]]
+        return stratum[rank]
+
+    def draw(self, seed: int):
+        '''Return the list of question indices drawn with seed (for audit)'''
+        return [self.question_index(seed, position) for position in range(self.q_count)]
+
+
+def allocate(total: int, sizes) -> tuple:
+    '''Split total between groups proportionally to their sizes (largest
+    remainder method), no group gets more than its size
+    If total allows, every group gets at least one
+    '''
+    base = [1 if total >= len(sizes) else 0 for _ in sizes]
+    total -= sum(base)
+    sizes = [size - b for size, b in zip(sizes, base)]
+    size_sum = sum(sizes)
+    if not size_sum:
+        return tuple(base)
+    quotas = [total * size / size_sum for size in sizes]
+    counts = [int(quota) for quota in quotas]
+    by_remainder = sorted(range(len(sizes)), key=lambda i: counts[i] - quotas[i])
+    for i in by_remainder[:total - sum(counts)]:
+        counts[i] += 1
+    return tuple(b + count for b, count in zip(base, counts))
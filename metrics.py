@@ -0,0 +1,198 @@
+import time
+
+from aiohttp import web
+from aiogram import Bot, types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+
+# Seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metric:
+    '''Base class of metrics with labels, rendered in Prometheus text format'''
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+    def label_text(self, label_values, extra=()):
+        pairs = list(zip(self.labels, label_values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{escape_label(v)}"' for k, v in pairs) + '}'
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = self.header()
+        for label_values, value in self.values.items():
+            lines.append(f'{self.name}{self.label_text(label_values)} {value}')
+        return lines
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, *label_values, value: float):
+        self.values[label_values] = value
+
+    def replace(self, values: dict):
+        '''Set all values at once, dropping the labels not in values'''
+        self.values = dict(values)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *label_values, value: float):
+        '''Record value for the given label values'''
+        counts = self.values.get(label_values)
+        if counts is None:
+            # Per bucket counts, then +Inf count and sum
+            counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[len(self.buckets)] += 1
+        counts[-1] += value
+
+    def summary(self, label_values):
+        '''Return (count, average, approximate 99th percentile)'''
+        counts = self.values.get(label_values)
+        if not counts:
+            return 0, 0.0, 0.0
+        total = sum(counts[:-1])
+        p99 = float('inf')
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= total * 0.99:
+                p99 = bound
+                break
+        return total, counts[-1] / total, p99
+
+    def render(self):
+        lines = self.header()
+        for label_values, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = self.label_text(label_values, [('le', bound)])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{self.label_text(label_values)} {counts[-1]}')
+            lines.append(f'{self.name}_count{self.label_text(label_values)} {cumulative}')
+        return lines
+
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REGISTRY = []
+
+HANDLER_SECONDS = Histogram('quizbot_handler_seconds', 'Time spent in update handlers', ['handler'])
+STORAGE_WRITE_SECONDS = Histogram('quizbot_storage_write_seconds', 'Time spent writing FSM storage')
+STORAGE_WRITE_CHARS = Counter('quizbot_storage_write_characters_total', 'Characters written to FSM storage')
+RESULTS_WRITE_SECONDS = Histogram('quizbot_results_write_seconds', 'Time spent writing the result log')
+RESULTS_WRITE_CHARS = Counter('quizbot_results_write_characters_total', 'Characters written to the result log')
+TELEGRAM_SECONDS = Histogram('quizbot_telegram_seconds', 'Telegram Bot API requests', ['method', 'outcome'])
+QUIZES_RELOAD_SECONDS = Histogram('quizbot_quizes_reload_seconds', 'Time spent reloading quizes')
+ACTIVE_QUIZES = Gauge('quizbot_active_quizes', 'Users answering questions', ['topic'])
+QUEUE_DEPTH = Gauge('quizbot_queue_depth', 'Requests waiting to be processed', ['queue'])
+
+
+def render() -> str:
+    '''Return all metrics in Prometheus text format'''
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+class InstrumentedBot(Bot):
+    '''Bot recording duration and outcome of every Bot API request'''
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(method, outcome, value=time.perf_counter() - started)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    '''Record time spent in message and callback query handlers'''
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self.start(data)
+
+    async def on_process_callback_query(self, query: types.CallbackQuery, data: dict):
+        self.start(data)
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self.finish(data)
+
+    async def on_post_process_callback_query(self, query: types.CallbackQuery, results, data: dict):
+        self.finish(data)
+
+    def start(self, data: dict):
+        data['metrics_handler'] = current_handler.get().__name__
+        data['metrics_started'] = time.perf_counter()
+
+    def finish(self, data: dict):
+        handler = data.pop('metrics_handler', None)
+        started = data.pop('metrics_started', None)
+        if handler is not None:
+            HANDLER_SECONDS.observe(handler, value=time.perf_counter() - started)
+
+
+def summary() -> str:
+    '''Return one line per handler and Bot API method for logs'''
+    lines = []
+    for metric in (HANDLER_SECONDS, TELEGRAM_SECONDS, STORAGE_WRITE_SECONDS, RESULTS_WRITE_SECONDS, QUIZES_RELOAD_SECONDS):
+        for label_values in sorted(metric.values):
+            count, avg, p99 = metric.summary(label_values)
+            name = ' '.join((metric.name,) + label_values)
+            lines.append(f'{name}: {count} calls, avg {avg * 1000:.1f} ms, p99 <= {p99 * 1000:.0f} ms')
+    for metric in (ACTIVE_QUIZES, QUEUE_DEPTH):
+        for label_values, value in sorted(metric.values.items()):
+            lines.append(f"{' '.join((metric.name,) + label_values)}: {value}")
+    return '\n'.join(lines)
+
+
+async def metrics_handler(request: web.Request):
+    return web.Response(body=render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    '''Serve GET /metrics, return the runner to be cleaned up on shutdown'''
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,90 @@
+import time
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+
+def update_chat_id(update: types.Update):
+    '''Return id of the chat whose FSM state the update may change'''
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        query = update.callback_query
+        return query.message.chat.id if query.message else query.from_user.id
+    return None
+
+
+class ChatLockMiddleware(BaseMiddleware):
+    '''Process updates of the same chat one at a time (across all bot
+    processes if the storage is shared), using storage.lock(chat)
+    '''
+
+    def __init__(self, storage):
+        super().__init__()
+        self.storage = storage
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        chat_id = update_chat_id(update)
+        if chat_id is None:
+            return
+        lock = self.storage.lock(chat_id)
+        await lock.__aenter__()
+        data['chat_lock'] = lock
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        lock = data.pop('chat_lock', None)
+        if lock is not None:
+            await lock.__aexit__(None, None, None)
+
+
+class ActivityMiddleware(BaseMiddleware):
+    '''Keep the time of the latest update of every private chat in its data
+    ('seen', unix time), used by SessionGC to find idle sessions
+    The time is written at most once per resolution seconds per chat, so it
+    hardly adds storage writes. Set it up after ChatLockMiddleware
+    '''
+
+    def __init__(self, storage, on_change, resolution: int = 3600):
+        super().__init__()
+        self.storage = storage
+        self.on_change = on_change
+        self.resolution = resolution
+        # chat -> 'seen' written last, only chats seen within resolution
+        self.written = {}
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        chat_id = update_chat_id(update)
+        sender = update.message or update.callback_query
+        if chat_id is None or sender is None or sender.from_user.id != chat_id:
+            # Not a private chat, there is no session to keep alive
+            return
+        now = int(time.time())
+        if now - self.written.get(chat_id, 0) < self.resolution:
+            return
+        self.written[chat_id] = now
+        try:
+            await self.storage.update_data(chat=chat_id, user=chat_id, data={'seen': now})
+            await self.on_change()
+        except Exception as e:
+            # Raising here would skip post-processing, i.e. leave the chat
+            # locked by ChatLockMiddleware, the time is written next time
+            self.written.pop(chat_id, None)
+            print(f'Oops, activity of chat {chat_id} was not saved: {e!r}')
+
+    def prune(self):
+        '''Forget chats which have not been seen within resolution'''
+        now = int(time.time())
+        self.written = {c: t for c, t in self.written.items() if now - t < self.resolution}
+
+
+class ReadinessMiddleware(BaseMiddleware):
+    '''Hold updates until ready (asyncio.Event) is set, so the bot may poll
+    while the storage and quizes are still being loaded. Set it up first
+    '''
+
+    def __init__(self, ready):
+        super().__init__()
+        self.ready = ready
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        await self.ready.wait()
@@ -0,0 +1,197 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from aiogram.utils import exceptions
+
+
+# Lower value is sent first
+PRIORITY_QUIZ = 0  # Questions for users answering them
+PRIORITY_USER = 1  # Other messages for users
+PRIORITY_ADMIN = 2  # Admission requests, results, etc
+PRIORITY_CLEANUP = 3  # Deletion of stale messages
+PRIORITY_NAMES = {
+    PRIORITY_QUIZ: 'quiz',
+    PRIORITY_USER: 'user',
+    PRIORITY_ADMIN: 'admin',
+    PRIORITY_CLEANUP: 'cleanup',
+}
+
+
+class TokenBucket:
+    '''rate tokens per second, up to capacity tokens may be spent at once'''
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'paused_until')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        '''Return seconds to wait for a token (0 if it is available now)'''
+        self.refill(now)
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, now: float, seconds: float):
+        '''Do not give tokens for seconds (after flood control error)'''
+        self.paused_until = max(self.paused_until, now + seconds)
+
+    def idle(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.capacity and self.paused_until <= now
+
+
+class OutboundScheduler:
+    '''Send Telegram API requests respecting global and per-chat limits
+
+    Requests wait in a priority queue, the one with the lowest priority
+    value whose chat has a token is started as soon as the global bucket has
+    a token as well. Flood control errors (RetryAfter) pause the chat and put
+    the request back to the queue up to max_retries times
+    '''
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 max_retries: int = 3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chat_buckets = {}
+        self._queue = []
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._worker = None
+        self._tasks = set()
+        self.sent = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.retries = 0
+        self.wait_total = dict.fromkeys(PRIORITY_NAMES, 0.0)
+        self.wait_max = dict.fromkeys(PRIORITY_NAMES, 0.0)
+
+    async def run(self, priority: int, chat_id, method, *args, **kwargs):
+        '''Queue method(*args, **kwargs) and return its result'''
+        if self._worker is None:
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.ensure_future(self._dispatch())
+        future = asyncio.get_running_loop().create_future()
+        call = (method, args, kwargs)
+        self._push(priority, str(chat_id), call, future, 0)
+        return await future
+
+    def _push(self, priority, chat_id, call, future, attempt):
+        enqueued = time.monotonic()
+        heapq.heappush(self._queue, (priority, next(self._counter), chat_id, call, future, attempt, enqueued))
+        self._wakeup.set()
+
+    def chat_bucket(self, chat_id: str) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _pop_ready(self, now: float):
+        '''Pop the first request whose chat has a token, return it along with
+        seconds to wait if there is no such request
+        '''
+        deferred = []
+        ready = None
+        wait = None
+        while self._queue:
+            item = heapq.heappop(self._queue)
+            delay = self.chat_bucket(item[2]).delay(now)
+            if not delay:
+                ready = item
+                break
+            deferred.append(item)
+            wait = delay if wait is None else min(wait, delay)
+        for item in deferred:
+            heapq.heappush(self._queue, item)
+        return ready, wait
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            global_delay = self.global_bucket.delay(now)
+            if global_delay:
+                await asyncio.sleep(global_delay)
+                continue
+            item, wait = self._pop_ready(now)
+            if item is None:
+                self._wakeup.clear()
+                if len(self.chat_buckets) > 10000:
+                    self.prune(now)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            priority, _, chat_id, call, future, attempt, enqueued = item
+            if future.cancelled():
+                continue
+            self.global_bucket.take()
+            self.chat_bucket(chat_id).take()
+            waited = now - enqueued
+            self.sent[priority] += 1
+            self.wait_total[priority] += waited
+            self.wait_max[priority] = max(self.wait_max[priority], waited)
+            task = asyncio.ensure_future(self._call(item))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _call(self, item):
+        priority, _, chat_id, (method, args, kwargs), future, attempt, _ = item
+        try:
+            result = await method(*args, **kwargs)
+        except exceptions.RetryAfter as e:
+            if attempt < self.max_retries:
+                self.retries += 1
+                self.chat_bucket(chat_id).pause(time.monotonic(), e.timeout)
+                self._push(priority, chat_id, (method, args, kwargs), future, attempt + 1)
+            elif not future.done():
+                future.set_exception(e)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+
+    def prune(self, now: float):
+        '''Forget buckets of chats which have not sent anything lately'''
+        queued = {item[2] for item in self._queue}
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if chat_id not in queued and bucket.idle(now):
+                del self.chat_buckets[chat_id]
+
+    def stats(self) -> dict:
+        '''Return queue depth, sent requests and wait times by priority'''
+        depth = dict.fromkeys(PRIORITY_NAMES, 0)
+        for item in self._queue:
+            depth[item[0]] += 1
+        stats = {'retries': self.retries, 'in_flight': len(self._tasks)}
+        for p, name in PRIORITY_NAMES.items():
+            stats[name] = {
+                'queued': depth[p],
+                'sent': self.sent[p],
+                'wait_avg': self.wait_total[p] / self.sent[p] if self.sent[p] else 0.0,
+                'wait_max': self.wait_max[p],
+            }
+        return stats
+
+    async def close(self, timeout: float = 10):
+        '''Wait (up to timeout seconds) for queued requests, call on shutdown'''
+        deadline = time.monotonic() + timeout
+        while (self._queue or self._tasks) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._worker is not None:
+            self._worker.cancel()
@@ -0,0 +1,614 @@
+import asyncio
+import contextlib
+import hashlib
+import os
+import tempfile
+import time
+
+import yaml
+
+from adaptive import MIN_QUESTIONS
+from banks import HOT_QUESTIONS, QuestionBank, write_bank
+from draws import DrawPlan, Permutation, mix64
+from metrics import QUIZES_RELOAD_SECONDS
+
+
+MD_SPECIAL_CHARACTERS = '_*[]()~`>#+-=|{}.!'
+MD_ESCAPE_TABLE = str.maketrans({c: f'\\{c}' for c in MD_SPECIAL_CHARACTERS})
+LETTERS = 'ABCDEFGHIJ'
+# libyaml-based loader is an order of magnitude faster if it is available
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+# Bump whenever Question or QuizSnapshot change to invalidate old caches
+CACHE_FORMAT = 9
+# Snapshot version is this many first characters of the file's sha256
+VERSION_LENGTH = 12
+MAX_ANSWERS = len(LETTERS)
+# Bot API limits: text of a message (after entities parsing, in UTF-16 code
+# units) and callback data of a button (in bytes)
+MESSAGE_LIMIT = 4096
+CALLBACK_DATA_LIMIT = 64
+# Topic codes are callback data of buttons, prefixed on the admission
+# dashboard ('dall_<code>', see admissions.render())
+TOPIC_CODE_LIMIT = CALLBACK_DATA_LIMIT - len('dall_')
+# Answer buttons are written as JSON right away, the data is appended
+ANSWER_BUTTONS = tuple('{"text":"%s","callback_data":"' % letter for letter in LETTERS)
+
+
+class QuizError(ValueError):
+    '''Quizes file cannot be loaded, args[0] is a list of problems'''
+
+
+class QuizSnapshot:
+    '''Questions and topics loaded from the file at some point in time,
+    never changed after creation (reload builds a new one)
+    version is derived from the file contents, so every bot process which
+    loaded the same file has the same version
+    '''
+    __slots__ = ('version', 'questions', 'topics', 'rendered')
+
+    def __init__(self, version: str, yaml_from_file):
+        validate_quizes(yaml_from_file)
+        self.version = version
+        self.questions = tuple(Question(question) for question in yaml_from_file['questions'])
+        report_problems([
+            f'Question #{index + 1} is {length} characters long, the limit is {MESSAGE_LIMIT}'
+            for index, length in enumerate(map(Question.rendered_length, self.questions))
+            if length > MESSAGE_LIMIT
+        ])
+        self.topics = self.parse_topics(yaml_from_file['enabled_topics'])
+        self.rendered = {}
+
+    @classmethod
+    def from_cache(cls, version: str, cached: dict):
+        '''Create snapshot from questions and topics loaded by load_cache()'''
+        snapshot = cls.__new__(cls)
+        snapshot.version = version
+        snapshot.questions = cached['questions']
+        snapshot.topics = cached['topics']
+        snapshot.rendered = {}
+        return snapshot
+
+    def render(self, key, render):
+        '''Return render() result, made once per snapshot and kept under key
+        (for texts and keyboards which only change on reload)
+        '''
+        try:
+            return self.rendered[key]
+        except KeyError:
+            result = self.rendered[key] = render()
+            return result
+
+    def load_uncached(self, index: int) -> 'Question':
+        '''Return question number index for a one-off pass over many questions'''
+        # Do not push the whole pass through the hot questions of a QuestionBank
+        load = getattr(self.questions, 'load', self.questions.__getitem__)
+        return load(index)
+
+    def parse_topics(self, enabled_topics):
+        '''Return a dictionary of topics within enabled_topics that have at
+        least one question the key is topic_code, the value is a dictionary
+        with keys: 'name', 'q_count', etc
+        {
+            'ccna': {
+                'name': 'CCNA',
+                'q_count': 20,
+                'show-correctness': False,
+                'show-correct': False,
+                'q_indices': (0, 1, 7),
+                'draw': None,
+                'admins': (),
+                'question-time': 60,
+                'quiz-time': None,
+                'adaptive': False,
+                'adaptive-tolerance': None,
+                'adaptive-min-questions': 5,
+                },
+        }
+        q_indices are indices of the topic's questions (a tuple, or a
+        QuestionBank array if the snapshot came from the cache), q_count is
+        the number of questions asked in a quiz, draw is a
+        DrawPlan for topics with sample, shuffle or stratify settings and
+        None for topics asked in file order, admins are chat ids of the
+        topic's admins (empty if the topic is handled by the global ones),
+        question-time and quiz-time are time limits in seconds (None if
+        there is no limit), questions of adaptive topics are picked by
+        DifficultyIndex as the quiz goes (draw is None for them), the quiz
+        stops early once the level has settled within adaptive-tolerance
+        (None never stops early) after adaptive-min-questions answers
+        '''
+        topics = {}
+        for index, question in enumerate(self.questions):
+            # Loop through every question
+            for q_topic in question.topics:
+                # And every space-separated topic within the question
+                if q_topic in enabled_topics:
+                    # Make sure topic is initialized
+                    topics.setdefault(
+                        q_topic,
+                        {
+                            'name': enabled_topics[q_topic]['name'],
+                            'show-correctness': 'show-correctness' in enabled_topics[q_topic].get('tags', []),
+                            'show-correct': 'show-correct' in enabled_topics[q_topic].get('tags', []),
+                            'admins': tuple(enabled_topics[q_topic].get('admins', [])),
+                            'question-time': enabled_topics[q_topic].get('question_time'),
+                            'quiz-time': enabled_topics[q_topic].get('quiz_time'),
+                            'adaptive': enabled_topics[q_topic].get('adaptive', False),
+                            'adaptive-tolerance': enabled_topics[q_topic].get('adaptive_tolerance'),
+                            'adaptive-min-questions': enabled_topics[q_topic].get('adaptive_min_questions', MIN_QUESTIONS),
+                            'q_indices': [],
+                        },
+                    )
+                    topics[q_topic]['q_indices'].append(index)
+        for topic_code, topic in topics.items():
+            topic['q_indices'] = tuple(topic['q_indices'])
+            settings = enabled_topics[topic_code]
+            if topic['adaptive']:
+                topic['draw'] = None
+                topic['q_count'] = min(settings.get('sample') or len(topic['q_indices']), len(topic['q_indices']))
+                continue
+            topic['draw'] = self.draw_plan(topic['q_indices'], settings)
+            topic['q_count'] = len(topic['q_indices']) if topic['draw'] is None else topic['draw'].q_count
+        return topics
+
+    def draw_plan(self, q_indices, settings: dict):
+        '''Return DrawPlan for the topic settings, None if questions are
+        asked in file order
+        '''
+        sample = settings.get('sample')
+        stratify = settings.get('stratify', [])
+        if sample is None and not settings.get('shuffle') and not stratify:
+            return None
+        # Every question goes to the stratum of the first tag it has
+        strata = [[] for _ in range(len(stratify) + 1)]
+        for index in q_indices:
+            topics = self.questions[index].topics
+            stratum_id = next((i for i, tag in enumerate(stratify) if tag in topics), len(stratify))
+            strata[stratum_id].append(index)
+        return DrawPlan(map(tuple, strata), sample)
+
+
+class Quizes:
+    '''Holds the current QuizSnapshot as well as older snapshots still used
+    by users who started their quiz before a reload
+    With cache_filename set, questions are read lazily from the compiled
+    cache (see QuestionBank), hot_questions of them are kept in memory
+    With load=False nothing is available until load() is called
+    '''
+    def __init__(self, filename: str, cache_filename: str = None, hot_questions: int = HOT_QUESTIONS,
+                 load: bool = True):
+        self.filename = filename
+        self.cache_filename = cache_filename
+        self.hot_questions = hot_questions
+        self.snapshots = {}
+        self._reload_lock = asyncio.Lock()
+        if load:
+            self.load()
+
+    @property
+    def snapshot(self) -> QuizSnapshot:
+        return self.snapshots[self.version]
+
+    @property
+    def topics(self):
+        return self.snapshot.topics
+
+    @property
+    def questions(self):
+        return self.snapshot.questions
+
+    def get(self, version=None) -> QuizSnapshot:
+        '''Return snapshot by version, the current one if version is None or
+        unknown (e.g. was loaded before restart)
+        '''
+        return self.snapshots.get(version, self.snapshot)
+
+    def build(self) -> QuizSnapshot:
+        '''Parse and validate the file (blocking)
+        If cache_filename is set, the compiled snapshot is taken from there
+        when the file has not changed, and saved there otherwise (and then
+        taken from there as well, so the parsed questions are not kept)
+        '''
+        try:
+            stat = os.stat(self.filename)
+            if self.cache_filename:
+                cached = load_cache(self.cache_filename, self.filename, self.hot_questions)
+                if cached is not None:
+                    return QuizSnapshot.from_cache(cached['digest'][:VERSION_LENGTH], cached)
+            with open(self.filename, 'rb') as file:
+                raw = file.read()
+        except FileNotFoundError:
+            raise QuizError([f'Check that there is a correct file {self.filename}'])
+        digest = hashlib.sha256(raw).hexdigest()
+        snapshot = QuizSnapshot(digest[:VERSION_LENGTH], yaml.load(raw, Loader=YAML_LOADER))
+        if self.cache_filename and save_cache(self.cache_filename, snapshot, stat, digest):
+            cached = read_cache(self.cache_filename, self.hot_questions)
+            if cached is not None:
+                return QuizSnapshot.from_cache(snapshot.version, cached)
+        return snapshot
+
+    def load(self):
+        '''Load quizes from file (blocking, used on startup)'''
+        snapshot = self.build()
+        self.snapshots = {snapshot.version: snapshot}
+        self.version = snapshot.version
+
+    async def reload(self, pinned_versions=()) -> str:
+        '''Build a new snapshot in a worker thread and make it current,
+        keep older snapshots listed in pinned_versions (used by active quizes)
+        as well as the outgoing current one (quizes may start on it while the
+        new one is being built, after pinned_versions were found)
+        Return a report describing the changes or the errors (the current
+        snapshot is kept in that case)
+        '''
+        async with self._reload_lock:
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
+            try:
+                new = await loop.run_in_executor(None, self.build)
+            except QuizError as e:
+                return 'Reload failed, nothing changed:\n' + '\n'.join(e.args[0])
+            except (OSError, yaml.YAMLError) as e:
+                return f'Reload failed, nothing changed:\n{e}'
+            finally:
+                QUIZES_RELOAD_SECONDS.observe(value=time.perf_counter() - started)
+            old = self.snapshot
+            snapshots = {v: s for v, s in self.snapshots.items() if v in pinned_versions or v == old.version}
+            snapshots[new.version] = new
+            # Single assignments, so handlers never see a half-updated state
+            self.snapshots = snapshots
+            self.version = new.version
+            return diff_report(old, new)
+
+
+def validate_quizes(yaml_from_file, max_problems: int = 20):
+    '''Raise QuizError listing (up to max_problems) problems of the file'''
+    problems = []
+    if not isinstance(yaml_from_file, dict):
+        raise QuizError(['File should contain enabled_topics and questions'])
+    enabled_topics = yaml_from_file.get('enabled_topics')
+    questions = yaml_from_file.get('questions')
+    if not isinstance(enabled_topics, dict):
+        problems.append('enabled_topics should be a mapping')
+    else:
+        for topic_code, topic in enabled_topics.items():
+            if not isinstance(topic, dict) or 'name' not in topic:
+                problems.append(f'Topic {topic_code} has no name')
+                continue
+            if len(str(topic_code).encode()) > TOPIC_CODE_LIMIT:
+                problems.append(f'Topic {topic_code} code should be up to {TOPIC_CODE_LIMIT} bytes long')
+            sample = topic.get('sample')
+            if sample is not None and (isinstance(sample, bool) or not isinstance(sample, int) or sample < 1):
+                problems.append(f'Topic {topic_code} sample should be a positive number')
+            if not isinstance(topic.get('shuffle', False), bool):
+                problems.append(f'Topic {topic_code} shuffle should be true or false')
+            stratify = topic.get('stratify', [])
+            if not (isinstance(stratify, list) and all(isinstance(tag, str) for tag in stratify)):
+                problems.append(f'Topic {topic_code} stratify should be a list of tags')
+            admins = topic.get('admins', [])
+            if not (isinstance(admins, list) and all(isinstance(a, int) and not isinstance(a, bool) for a in admins)):
+                problems.append(f'Topic {topic_code} admins should be a list of chat ids')
+            if not isinstance(topic.get('adaptive', False), bool):
+                problems.append(f'Topic {topic_code} adaptive should be true or false')
+            elif topic.get('adaptive') and (topic.get('shuffle') or stratify):
+                problems.append(f'Topic {topic_code} is adaptive, its questions cannot be shuffled or stratified')
+            tolerance = topic.get('adaptive_tolerance')
+            if tolerance is not None and (isinstance(tolerance, bool) or not isinstance(tolerance, (int, float)) or not 0 < tolerance < 1):
+                problems.append(f'Topic {topic_code} adaptive_tolerance should be a number between 0 and 1')
+            min_questions = topic.get('adaptive_min_questions', MIN_QUESTIONS)
+            if isinstance(min_questions, bool) or not isinstance(min_questions, int) or min_questions < 1:
+                problems.append(f'Topic {topic_code} adaptive_min_questions should be a positive number')
+            for limit in ('question_time', 'quiz_time'):
+                seconds = topic.get(limit)
+                if seconds is not None and (isinstance(seconds, bool) or not isinstance(seconds, (int, float)) or seconds <= 0):
+                    problems.append(f'Topic {topic_code} {limit} should be a positive number of seconds')
+    if not isinstance(questions, list):
+        problems.append('questions should be a list')
+        questions = []
+    for index, question in enumerate(questions):
+        if not isinstance(question, dict):
+            problems.append(f'Question #{index + 1} is not a mapping')
+            continue
+        for key in ('t', 'q', 'a'):
+            if key not in question:
+                problems.append(f'Question #{index + 1} has no {key}')
+        for key, name in (('t', 'topics'), ('q', 'question')):
+            if key in question and not isinstance(question[key], str):
+                problems.append(f'Question #{index + 1} {name} ({key}) should be a string')
+        answers = question.get('a')
+        if 'a' in question and not (isinstance(answers, list) and 2 <= len(answers) <= MAX_ANSWERS):
+            problems.append(f'Question #{index + 1} should have 2..{MAX_ANSWERS} answers')
+        elif 'a' in question and not all(isinstance(a, (str, int, float)) for a in answers):
+            problems.append(f'Question #{index + 1} answers should be strings or numbers')
+    report_problems(problems, max_problems)
+
+
+def report_problems(problems, max_problems: int = 20):
+    '''Raise QuizError listing up to max_problems problems, if there are any'''
+    if problems:
+        if len(problems) > max_problems:
+            problems = problems[:max_problems] + [f'...and {len(problems) - max_problems} more']
+        # Problems quote the file, keep the report within a message
+        raise QuizError([problem[:MESSAGE_LIMIT // (max_problems + 2)] for problem in problems])
+
+
+def diff_report(old: QuizSnapshot, new: QuizSnapshot, max_lines: int = 40) -> str:
+    '''Return a human readable difference between two snapshots (up to
+    max_lines changed topics)
+    '''
+    lines = [f'Reloaded v{old.version} -> v{new.version}: {len(old.questions)} -> {len(new.questions)} questions']
+    for topic_code in new.topics.keys() - old.topics.keys():
+        lines.append(f"+ {topic_code} ({new.topics[topic_code]['q_count']})")
+    for topic_code in old.topics.keys() - new.topics.keys():
+        lines.append(f"- {topic_code} ({old.topics[topic_code]['q_count']})")
+    for topic_code in new.topics.keys() & old.topics.keys():
+        old_count = old.topics[topic_code]['q_count']
+        new_count = new.topics[topic_code]['q_count']
+        if old_count != new_count:
+            lines.append(f'~ {topic_code} ({old_count} -> {new_count})')
+    if len(lines) == 1:
+        lines.append('No changes in topics')
+    elif len(lines) > max_lines + 1:
+        lines = lines[:max_lines + 1] + [f'...and {len(lines) - 1 - max_lines} more']
+    return '\n'.join(lines)
+
+
+def file_digest(filename) -> str:
+    with open(filename, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def read_cache(cache_filename, hot_questions: int = HOT_QUESTIONS):
+    '''Return {'stat', 'digest', 'questions', 'topics'} of the compiled
+    cache, None if there is no cache or it has another format
+    Questions and topics' question indices stay on disk until used
+    '''
+    try:
+        bank = QuestionBank(cache_filename, hot_questions)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f'Oops, ignoring broken cache {cache_filename}: {e!r}')
+        return None
+    cached = bank.header
+    if cached.get('format') != CACHE_FORMAT:
+        return None
+    topics = {}
+    for topic_code, saved in cached['topics'].items():
+        topic = topics[topic_code] = dict(saved)
+        # Indices of stratified topics are saved stratum by stratum
+        topic['q_indices'] = bank.array(topic_code)
+        if saved['draw'] is not None:
+            strata = []
+            start = 0
+            for size in saved['draw']:
+                strata.append(topic['q_indices'][start:start + size])
+                start += size
+            topic['draw'] = DrawPlan(strata, saved['q_count'])
+    return {'stat': cached['stat'], 'digest': cached['digest'], 'questions': bank, 'topics': topics}
+
+
+def load_cache(cache_filename, filename, hot_questions: int = HOT_QUESTIONS):
+    '''Return read_cache() result if the cache was made from the same file
+    (same size and mtime or, if those differ, same sha256), None otherwise
+    '''
+    cached = read_cache(cache_filename, hot_questions)
+    if cached is None:
+        return None
+    stat = os.stat(filename)
+    if cached['stat'] == (stat.st_size, stat.st_mtime_ns):
+        return cached
+    if cached['digest'] == file_digest(filename):
+        return cached
+    return None
+
+
+def save_cache(cache_filename, snapshot: QuizSnapshot, stat: os.stat_result, digest: str) -> bool:
+    '''Save compiled snapshot as a question bank, return whether it was
+    saved (failing to do so is not fatal)
+    stat should be taken before the file was read, so that the cache made
+    from the file changed in between is detected by the digest
+    '''
+    topics = {}
+    arrays = {}
+    for topic_code, topic in snapshot.topics.items():
+        topics[topic_code] = dict(topic, q_indices=None, draw=None)
+        if topic['draw'] is None:
+            arrays[topic_code] = topic['q_indices']
+        else:
+            topics[topic_code]['draw'] = tuple(map(len, topic['draw'].strata))
+            arrays[topic_code] = [index for stratum in topic['draw'].strata for index in stratum]
+    header = {
+        'format': CACHE_FORMAT,
+        'stat': (stat.st_size, stat.st_mtime_ns),
+        'digest': digest,
+        'topics': topics,
+    }
+    # Snapshots still in use keep the replaced file mapped. The temporary
+    # file is unique, so bot processes starting together do not write (and
+    # map) the same one
+    tmp_filename = None
+    try:
+        fd, tmp_filename = tempfile.mkstemp(
+            prefix=f'{os.path.basename(cache_filename)}.', suffix='.tmp',
+            dir=os.path.dirname(os.path.abspath(cache_filename)),
+        )
+        os.close(fd)
+        write_bank(tmp_filename, snapshot.questions, arrays, header)
+        os.replace(tmp_filename, cache_filename)
+        return True
+    except OSError as e:
+        print(f'Oops, cannot save cache {cache_filename}: {e!r}')
+        if tmp_filename is not None:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_filename)
+        return False
+
+
+def load_yaml(filename):
+    '''Load yaml-file or return None if file does not exist'''
+    try:
+        with open(filename, 'r', encoding='utf8') as file:
+            return yaml.load(file, Loader=YAML_LOADER)
+    except FileNotFoundError:
+        return None
+
+
+def my_md(text: str, plaintext: bool = False) -> str:
+    '''Prepare text for Markdown by either removing 'MD:' prefix or
+    escaping some characters for Telegram Markdown
+    Setting plaintext to True returns plaintext (no MD formatting) version to
+    use in notifications showing the correct answer
+    '''
+    if text.startswith('MD:'):
+        result = text.replace('MD:', '', 1)
+        if plaintext:
+            return md_plaintext(result)
+        else:
+            return result
+    elif plaintext:
+        # Do not escape anything - text is already plaintext
+        return text
+    return text.translate(MD_ESCAPE_TABLE)
+
+
+def md_plaintext(text: str) -> str:
+    '''Return MarkdownV2 text without formatting characters and escapes'''
+    result = ''
+    escaped = False
+    for letter in text:
+        if not escaped and letter == '\\':
+            escaped = True
+            continue
+        if letter in MD_SPECIAL_CHARACTERS:
+            if escaped:
+                escaped = False
+                result += letter
+        else:
+            result += letter
+    return result
+
+
+def utf16_length(text: str) -> int:
+    '''Return length of text the way Bot API counts it'''
+    return len(text.encode('utf-16-le')) // 2
+
+
+class Question:
+    '''Question precompiled from a yaml record (immutable)
+
+    - topics - set of topic codes from 't';
+    - text - question text ready to be sent (escaped if parse_mode is set);
+    - answers - tuple of (answer_text, points) with answer_text ready to be
+      appended after the 'A. ' prefix, the correct answer goes first;
+    - parse_mode - either 'MarkdownV2' or '';
+    - correct_answer - plaintext correct answer for notifications;
+    - key - short digest of the question and its answers, stays the same
+      across reloads unless the question is changed (used by ResultLog).
+    '''
+    __slots__ = ('topics', 'text', 'answers', 'parse_mode', 'correct_answer', 'key')
+
+    def __init__(self, question: dict):
+        text = question['q']
+        raw_answers = list(map(str, question['a']))
+        correct_answer = raw_answers[0]
+        # use_md will be True if question or any answer startswith 'MD:', False otherwise
+        use_md = text.startswith('MD:') or any(
+            map(lambda s: s.startswith('MD:'), raw_answers))
+        if use_md:
+            text = my_md(text)
+        answers = tuple(
+            (my_md(a) if use_md else a, int(a == correct_answer))
+            for a in raw_answers
+        )
+        object.__setattr__(self, 'topics', frozenset(question['t'].split()))
+        object.__setattr__(self, 'text', text)
+        object.__setattr__(self, 'answers', answers)
+        object.__setattr__(self, 'parse_mode', 'MarkdownV2' if use_md else '')
+        object.__setattr__(self, 'correct_answer', my_md(correct_answer, plaintext=True))
+        key = hashlib.sha256('\n'.join([question['q']] + raw_answers).encode()).hexdigest()
+        object.__setattr__(self, 'key', key[:VERSION_LENGTH])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Question is immutable')
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
+    def answer_prefix(self, letter: str) -> str:
+        r'''Return answer line prefix based on parse_mode:
+
+        parse_mode == ''
+        - `Answer-A text`     ->  A. `Answer-A text`
+
+        parse_mode == 'MarkdownV2'
+        - `Answer-A text`     ->  A\. \`Answer\-A text\`
+        - MD:`Answer-B text`  ->  B\. `Answer-B text`
+        '''
+        return letter + ('\\' if self.parse_mode else '') + '. '
+
+    def rendered_length(self) -> int:
+        '''Return length of the question message (the same whatever the order
+        of answers is), formatting does not count for MarkdownV2
+        '''
+        text = '\n'.join([self.text, ''] + [
+            self.answer_prefix(letter) + answer for letter, (answer, _) in zip(LETTERS, self.answers)
+        ])
+        length = utf16_length(text)
+        if self.parse_mode and length > MESSAGE_LIMIT:
+            # Formatting only makes the text longer, strip it if it matters
+            length = utf16_length(md_plaintext(text))
+        return length
+
+
+def get_question(quizes, topic_code, q_id, seed=0, index=None):
+    '''Return q_id-th Question of the topic drawn with seed (see
+    prepare_question()), None if there are no more questions
+    index (within quizes questions) is given for adaptive topics
+    '''
+    topic = quizes.topics[topic_code]
+    if q_id > topic['q_count'] - 1:
+        return None
+    if index is not None:
+        return quizes.questions[index]
+    if topic['draw'] is None:
+        return quizes.questions[topic['q_indices'][q_id]]
+    return quizes.questions[topic['draw'].question_index(seed, q_id)]
+
+
+def answer_order(question: Question, seed: int, q_id: int):
+    '''Return indices of question.answers in the order they are shown
+    (the same for the same seed, so the chosen one can be found later on)
+    '''
+    permutation = Permutation(len(question.answers), mix64(seed) ^ q_id)
+    return [permutation[i] for i in range(len(question.answers))]
+
+
+def prepare_question(quizes, topic_code, q_id, seed=0, signer=None, index=None):
+    '''quizes is either Quizes (current snapshot is used) or QuizSnapshot
+    seed defines the draw of topics with a DrawPlan and the order of answers
+    signer (AnswerSigner) makes callback data of the buttons, if it is None
+    the data is unsigned '<q_id>.<option>' (for benchmarks)
+    index is the question picked by DifficultyIndex for adaptive topics
+    Return a tuple of q+rnd(asnwers), inline_kb(('A', 'a0.0.sig'), ...)
+    and parse_mode (either 'MarkdownV2' or '')
+    or (None, None, None) if there are no more questions
+    inline_kb is serialized already (reply_markup is sent as JSON anyway),
+    so no keyboard objects are built per question
+    '''
+    letters = LETTERS
+    question = get_question(quizes, topic_code, q_id, seed, index)
+    if question is None:
+        return (None, None, None)
+    lines = [question.text, '']  # Extra newline right after the question
+    buttons = []
+    for option, index in enumerate(answer_order(question, seed, q_id)):
+        lines.append(question.answer_prefix(letters[option]) + question.answers[index][0])
+        # Neither letters nor signed data need JSON escaping
+        callback_data = signer.sign(q_id, option) if signer else f'{q_id}.{option}'
+        buttons.append(ANSWER_BUTTONS[option] + callback_data + '"}')
+    keyboard_markup = '{"inline_keyboard":[[' + ','.join(buttons) + ']]}'
+    return ('\n'.join(lines), keyboard_markup, question.parse_mode)
@@ -0,0 +1,194 @@
+import json
+import os
+import pathlib
+import threading
+
+from quizes import LETTERS
+
+
+class ResultLog:
+    '''Append-only log of answers with per-question statistics kept up to
+    date incrementally (nothing is rescanned when the statistics are asked)
+
+    Layout on disk (for path='results.jsonl'):
+    - results.jsonl        - live log, one flat JSON object per answer;
+    - results.jsonl.1, .2  - rotated logs, the larger number the newer;
+    - results.jsonl.stats  - statistics checkpoint along with the size of
+                             the live log it covers.
+
+    Answers are buffered by record() and written by collect()/commit()
+    (driven by FlushScheduler, so commit() runs in a worker thread). On
+    startup the checkpoint is loaded and only the tail of the live log is
+    replayed on top of it (all the logs if there is no checkpoint), with
+    load=False that is done by load() later on
+    '''
+
+    def __init__(self, path, rotate_bytes: int = 64 * 2**20, checkpoint_every: int = 10000, load: bool = True):
+        self.path = pathlib.Path(path)
+        self.stats_path = pathlib.Path(f'{path}.stats')
+        self.rotate_bytes = rotate_bytes
+        self.checkpoint_every = checkpoint_every
+        # question key -> {'n', 'correct', 'seconds', 'picks'}, picks[i] is the
+        # number of times answer i (in file order, 0 is correct) was chosen
+        self.stats = {}
+        self._buffer = []
+        # Lines collect() has returned but commit() failed to write
+        self._unwritten = []
+        self._since_checkpoint = 0
+        self._lock = threading.Lock()
+        self._file = None
+        if load:
+            self.load()
+
+    def load(self):
+        '''Restore the statistics and open the live log (blocking)'''
+        self._restore()
+        self._file = self.path.open('a', encoding='utf8')
+
+    def _restore(self):
+        try:
+            with self.stats_path.open('r', encoding='utf8') as file:
+                checkpoint = json.load(file)
+        except FileNotFoundError:
+            checkpoint = None
+        except ValueError as e:
+            print(f'Oops, ignoring broken checkpoint {self.stats_path}: {e!r}')
+            checkpoint = None
+        size = self.path.stat().st_size if self.path.exists() else 0
+        if checkpoint is not None and checkpoint['offset'] <= size:
+            self.stats = checkpoint['stats']
+            self._replay(self.path, checkpoint['offset'])
+            return
+        for segment in self.segments():
+            self._replay(segment)
+        self._replay(self.path)
+
+    def segments(self):
+        '''Return rotated logs, the oldest first'''
+        numbered = []
+        for segment in self.path.parent.glob(f'{self.path.name}.*'):
+            suffix = segment.name[len(self.path.name) + 1:]
+            if suffix.isdigit():
+                numbered.append((int(suffix), segment))
+        return [segment for _, segment in sorted(numbered)]
+
+    def _replay(self, path: pathlib.Path, offset: int = 0):
+        if not path.exists():
+            return
+        with path.open('rb') as file:
+            file.seek(offset)
+            for line in file:
+                try:
+                    self.add(json.loads(line))
+                except ValueError:
+                    # Line torn by a crash
+                    print(f'Oops, skipping broken line of {path}')
+
+    def add(self, record: dict):
+        '''Account a single answer in the statistics'''
+        stats = self.stats.get(record['question'])
+        if stats is None:
+            stats = self.stats[record['question']] = {'n': 0, 'correct': 0, 'seconds': 0.0, 'picks': []}
+        stats['n'] += 1
+        stats['correct'] += record['points']
+        stats['seconds'] += record['seconds']
+        picks = stats['picks']
+        if len(picks) <= record['chosen']:
+            picks.extend([0] * (record['chosen'] + 1 - len(picks)))
+        picks[record['chosen']] += 1
+
+    def record(self, **fields):
+        '''Buffer an answer (cheap, call FlushScheduler.mark_dirty() next)'''
+        self._buffer.append(fields)
+
+    def collect(self):
+        '''Serialize buffered answers and account them in the statistics'''
+        if not self._buffer and not self._unwritten:
+            return None
+        records, self._buffer = self._buffer, []
+        # Already accounted in the statistics
+        lines, self._unwritten = self._unwritten, []
+        for record in records:
+            self.add(record)
+            lines.append(json.dumps(record, ensure_ascii=False))
+        return lines
+
+    def rollback(self, lines):
+        '''Keep lines returned by collect() for the next one (their commit()
+        failed)
+        '''
+        self._unwritten = lines + self._unwritten
+
+    def commit(self, lines):
+        '''Append lines returned by collect(), rotate the log if it is too
+        large (may be called from another thread)
+        '''
+        with self._lock:
+            self._file.write('\n'.join(lines) + '\n')
+            self._file.flush()
+            self._since_checkpoint += len(lines)
+            if self._file.tell() >= self.rotate_bytes:
+                self._rotate()
+            elif self._since_checkpoint >= self.checkpoint_every:
+                self._checkpoint()
+
+    def _rotate(self):
+        segments = self.segments()
+        number = int(segments[-1].name.rsplit('.', 1)[1]) + 1 if segments else 1
+        self._file.close()
+        os.replace(self.path, f'{self.path}.{number}')
+        self._file = self.path.open('a', encoding='utf8')
+        self._checkpoint()
+
+    def _checkpoint(self):
+        '''Save the statistics covering everything written so far'''
+        tmp_path = pathlib.Path(f'{self.stats_path}.tmp')
+        with tmp_path.open('w', encoding='utf8') as file:
+            json.dump({'offset': self._file.tell(), 'stats': self.stats}, file)
+        os.replace(tmp_path, self.stats_path)
+        self._since_checkpoint = 0
+
+    def close(self):
+        '''Call after the final flush'''
+        if self._file is None:
+            return
+        with self._lock:
+            self._checkpoint()
+            self._file.close()
+
+
+def stats_report(stats: dict, snapshot, topic_code: str = None, limit: int = 20) -> str:
+    '''Return per-question statistics of the topic (all topics if topic_code
+    is None) of the snapshot, the hardest questions first
+    Goes through every question of the topic (blocking, run in a worker
+    thread for big ones)
+    '''
+    if topic_code is None:
+        indices = range(len(snapshot.questions))
+    else:
+        indices = snapshot.topics[topic_code]['q_indices']
+    rows = []
+    for index in indices:
+        question = snapshot.load_uncached(index)
+        question_stats = stats.get(question.key)
+        if question_stats:
+            rows.append((question_stats['correct'] / question_stats['n'], index, question_stats))
+    if not rows:
+        return 'No answers yet'
+    rows.sort(key=lambda row: (row[0], row[1]))
+    lines = [f'{len(rows)} questions answered, the hardest first:']
+    for accuracy, index, question_stats in rows[:limit]:
+        n = question_stats['n']
+        # Answers in file order, A is the correct one
+        picks = ' '.join(
+            f'{LETTERS[i]} {count / n:.0%}'
+            for i, count in enumerate(question_stats['picks']) if count
+        )
+        text = load(index).text.replace('\n', ' ')
+        lines.append(
+            f"#{index + 1} {text[:40]}: {accuracy:.0%} of {n}, "
+            f"avg {question_stats['seconds'] / n:.0f}s, picks {picks}"
+        )
+    if len(rows) > limit:
+        lines.append(f'...and {len(rows) - limit} more')
+    return '\n'.join(lines)
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import pathlib
+import time
+
+
+# Bot API deletes messages up to 48 hours old only
+DELETE_WINDOW = 48 * 3600
+
+
+class SessionGC:
+    '''Drop sessions (storage records) idle for longer than ttl seconds and
+    trim 'delete' lists of messages too old to be deleted
+
+    Idle time is taken from 'seen' within the data (see ActivityMiddleware),
+    which is up to resolution seconds behind the latest update. Records
+    without 'seen' (made before it was kept) are stamped on the first pass,
+    so they expire ttl seconds later. If archive_path is set, dropped
+    records are appended there (one JSON line {chat, user, record} each)
+    instead of being lost. ttl=None keeps sessions forever (only 'delete'
+    lists are trimmed). on_evict(chat, user, record) coroutine is awaited
+    for every dropped record
+    '''
+
+    def __init__(self, storage, ttl: float = None, archive_path=None, resolution: int = 3600, on_evict=None):
+        self.storage = storage
+        self.ttl = ttl
+        self.archive_path = pathlib.Path(archive_path) if archive_path else None
+        self.resolution = resolution
+        self.on_evict = on_evict
+        self.last_report = None
+
+    async def collect(self) -> dict:
+        '''Make a pass over the storage, return what was done along with the
+        number and JSON size of records before and after it
+        '''
+        now = int(time.time())
+        report = dict.fromkeys(('records_before', 'chars_before', 'records_after', 'chars_after',
+                                'evicted', 'trimmed', 'stamped'), 0)
+        archived = []
+        scanned = 0
+        async for chat, user, record in self.storage.records():
+            size = len(json.dumps(record, ensure_ascii=False))
+            report['records_before'] += 1
+            report['chars_before'] += size
+            scanned += 1
+            if scanned % 1000 == 0:
+                # Let updates be processed meanwhile
+                await asyncio.sleep(0)
+            seen = record['data'].get('seen')
+            idle = None if seen is None else now - seen
+            if seen is not None and not self.expired(idle) and not self.too_old_to_delete(idle, record):
+                report['records_after'] += 1
+                report['chars_after'] += size
+                continue
+            async with self.storage.lock(chat):
+                # Read again, the record may have changed while not locked
+                state = await self.storage.get_state(chat=chat, user=user)
+                data = await self.storage.get_data(chat=chat, user=user)
+                seen = data.get('seen')
+                idle = None if seen is None else now - seen
+                if seen is None:
+                    await self.storage.update_data(chat=chat, user=user, data={'seen': now})
+                    report['stamped'] += 1
+                elif self.expired(idle):
+                    record = {'state': state, 'data': data}
+                    await self.storage.remove(chat=chat, user=user)
+                    if self.archive_path is not None:
+                        archived.append(json.dumps({'chat': chat, 'user': user, 'record': record}, ensure_ascii=False))
+                    report['evicted'] += 1
+                    if self.on_evict is not None:
+                        await self.on_evict(chat, user, record)
+                    continue
+                elif self.too_old_to_delete(idle, {'data': data}):
+                    await self.storage.update_data(chat=chat, user=user, data={'delete': []})
+                    report['trimmed'] += 1
+                record = {'state': state, 'data': await self.storage.get_data(chat=chat, user=user)}
+            report['records_after'] += 1
+            report['chars_after'] += len(json.dumps(record, ensure_ascii=False))
+        if archived:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.archive, archived)
+        self.last_report = report
+        return report
+
+    def expired(self, idle) -> bool:
+        return self.ttl is not None and idle > self.ttl
+
+    def too_old_to_delete(self, idle, record: dict) -> bool:
+        # Messages were sent before the chat was last seen (give or take resolution)
+        return bool(record['data'].get('delete')) and idle > DELETE_WINDOW + self.resolution
+
+    def archive(self, lines):
+        with self.archive_path.open('a', encoding='utf8') as file:
+            file.write('\n'.join(lines) + '\n')
+
+
+def gc_report(report: dict) -> str:
+    return (
+        f"Sessions: {report['records_before']} ({report['chars_before'] / 2**20:.2f} MiB) -> "
+        f"{report['records_after']} ({report['chars_after'] / 2**20:.2f} MiB), "
+        f"evicted {report['evicted']}, trimmed {report['trimmed']}, stamped {report['stamped']}"
+    )
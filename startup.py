@@ -0,0 +1,42 @@
+import contextlib
+import time
+
+
+class StartupProfile:
+    '''Seconds spent on startup steps (see --profile-startup)
+    started is time.perf_counter() taken at the very beginning
+    '''
+
+    def __init__(self, started: float):
+        self.started = started
+        self.marked = started
+        self.steps = []
+
+    def add(self, name: str, seconds: float):
+        self.steps.append((name, seconds))
+
+    def mark(self, name: str):
+        '''Record time since the previous mark (since started for the first)'''
+        now = time.perf_counter()
+        self.add(name, now - self.marked)
+        self.marked = now
+
+    @contextlib.contextmanager
+    def step(self, name: str):
+        '''Time the block (may be used in worker threads as well)'''
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def since_start(self, name: str):
+        '''Record time from started up to now'''
+        self.add(f'{name} (since start)', time.perf_counter() - self.started)
+
+    def report(self) -> str:
+        width = max(len(name) for name, _ in self.steps)
+        lines = ['Startup profile:']
+        for name, seconds in self.steps:
+            lines.append(f'  {name:<{width}} {seconds:>8.3f} s')
+        return '\n'.join(lines)
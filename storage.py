@@ -0,0 +1,554 @@
+import asyncio
+import json
+import os
+import pathlib
+import threading
+import time
+import typing
+
+from aiogram.contrib.fsm_storage.files import JSONStorage
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.storage import BaseStorage
+
+from metrics import STORAGE_WRITE_CHARS, STORAGE_WRITE_SECONDS
+
+
+class LocalStorageMixin:
+    '''Loading, locking and iteration for storages keeping all the data in
+    memory of a single process (self.data[chat][user] = {'state', 'data',
+    'bucket'}) and reading it from a file
+    With load=False the file is read by load() later on (e.g. in a worker
+    thread while the bot is already polling), the storage must not be used
+    until then
+    '''
+
+    def __init__(self, path, load: bool = True):
+        # Not JSONStorage.__init__(), it reads the file right away
+        MemoryStorage.__init__(self)
+        self.path = pathlib.Path(path)
+        self.loaded = False
+        if load:
+            self.load()
+
+    def load(self):
+        '''Read the file (blocking)'''
+        try:
+            self.data = self.read(self.path)
+        except FileNotFoundError:
+            pass
+        self.loaded = True
+
+    async def close(self):
+        if not self.loaded:
+            # Reading failed or never happened, keep the file as it is
+            return
+        await super().close()
+
+    def lock(self, chat):
+        '''Return a lock serializing updates of the chat (async context
+        manager), the lock object is dropped once nobody waits for it
+        '''
+        if not hasattr(self, '_chat_locks'):
+            self._chat_locks = {}
+        return _LocalLock(self._chat_locks, str(chat))
+
+    async def records(self):
+        '''Yield (chat, user, {'state', 'data', 'bucket'}) for every user'''
+        for chat, users in list(self.data.items()):
+            for user, record in list(users.items()):
+                yield chat, user, record
+
+    async def remove(self, *, chat=None, user=None):
+        '''Forget the user's record altogether'''
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        users = self.data.get(chat, {})
+        users.pop(user, None)
+        if not users:
+            self.data.pop(chat, None)
+
+
+class _LocalLock:
+    def __init__(self, locks: dict, chat: str):
+        self.locks = locks
+        self.chat = chat
+
+    async def __aenter__(self):
+        lock, waiters = self.locks.get(self.chat, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self.locks[self.chat] = (lock, waiters + 1)
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._forget(lock)
+            raise
+
+    async def __aexit__(self, *exc_info):
+        lock, _ = self.locks[self.chat]
+        lock.release()
+        self._forget(lock)
+
+    def _forget(self, lock):
+        _, waiters = self.locks[self.chat]
+        if waiters == 1:
+            del self.locks[self.chat]
+        else:
+            self.locks[self.chat] = (lock, waiters - 1)
+
+
+class WALStorage(LocalStorageMixin, JSONStorage):
+    '''JSONStorage that appends per-chat deltas to a write-ahead log instead of
+    rewriting the whole file on every write()
+
+    Layout on disk (for path='fsm_storage.json'):
+    - fsm_storage.json        - snapshot, same format as JSONStorage uses;
+    - fsm_storage.json.wal    - live log, one JSON line per changed chat:
+                                {"chat": "123", "value": {...} or null};
+    - fsm_storage.json.wal.1  - rotated log being merged into the snapshot.
+
+    Once the live log has more than compact_after lines it is rotated and
+    merged into the snapshot by a background thread (only files are touched
+    there, never self.data). On startup the snapshot is loaded and both logs
+    are replayed on top of it
+    '''
+
+    def __init__(self, path, compact_after: int = 1000, fsync: bool = False, load: bool = True):
+        self.compact_after = compact_after
+        self.fsync = fsync
+        self.log_path = pathlib.Path(f'{path}.wal')
+        self.old_log_path = pathlib.Path(f'{path}.wal.1')
+        self._dirty = set()
+        self._log_lines = 0
+        self._lock = threading.Lock()
+        self._compaction = None
+        self._log = None
+        super().__init__(path, load=load)
+
+    def load(self):
+        '''Read the snapshot and replay the logs on top of it (blocking)'''
+        super().load()
+        replay_log(self.data, self.old_log_path)
+        # New records are appended to the live log, so it should not end
+        # with a torn line
+        self._log_lines = replay_log(self.data, self.log_path, truncate=True)
+        if self.old_log_path.exists():
+            # Previous merge was interrupted
+            self.compact()
+        self._log = self.log_path.open('a', encoding='utf8')
+
+    def _mark(self, chat, user):
+        chat, _ = self.check_address(chat=chat, user=user)
+        self._dirty.add(str(chat))
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        await super().set_state(chat=chat, user=user, state=state)
+        self._mark(chat, user)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        await super().set_data(chat=chat, user=user, data=data)
+        self._mark(chat, user)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        await super().update_data(chat=chat, user=user, data=data, **kwargs)
+        self._mark(chat, user)
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        await super().set_bucket(chat=chat, user=user, bucket=bucket)
+        self._mark(chat, user)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        await super().update_bucket(chat=chat, user=user, bucket=bucket, **kwargs)
+        self._mark(chat, user)
+
+    async def remove(self, *, chat=None, user=None):
+        await super().remove(chat=chat, user=user)
+        self._mark(chat, user)
+
+    def read(self, path: pathlib.Path):
+        with path.open('r', encoding='utf8') as file:
+            return json.load(file)
+
+    def write(self, path=None):
+        '''Append records of the chats changed since the last write() to the
+        log, path is ignored (kept for JSONStorage compatibility)
+        '''
+        self.commit(self.collect())
+
+    def collect(self):
+        '''Serialize records of the chats changed since the last call
+        Cheap (proportional to the number of changed chats), so it is safe to
+        call on the event loop
+        '''
+        lines = []
+        for chat in self._dirty:
+            lines.append(json.dumps({'chat': chat, 'value': self.data.get(chat)}, ensure_ascii=False))
+        self._dirty.clear()
+        return lines
+
+    def rollback(self, lines):
+        '''Mark chats of lines returned by collect() changed again (their
+        commit() failed)
+        '''
+        self._dirty.update(json.loads(line)['chat'] for line in lines)
+
+    def commit(self, lines):
+        '''Append lines returned by collect() to the log, does not touch
+        self.data so may be called from another thread
+        '''
+        if not lines:
+            return
+        with self._lock:
+            self._log.write('\n'.join(lines) + '\n')
+            self._log.flush()
+            if self.fsync:
+                os.fsync(self._log.fileno())
+            self._log_lines += len(lines)
+            if self._log_lines >= self.compact_after:
+                self._rotate()
+
+    def _rotate(self):
+        '''Move the live log aside and merge it into the snapshot in a
+        background thread (skipped if the previous merge is still running)
+        '''
+        if self._compaction is not None and self._compaction.is_alive():
+            return
+        self._log.close()
+        os.replace(self.log_path, self.old_log_path)
+        self._log = self.log_path.open('a', encoding='utf8')
+        self._log_lines = 0
+        self._compaction = threading.Thread(target=self.compact, daemon=True)
+        self._compaction.start()
+
+    def compact(self):
+        '''Merge the rotated log into the snapshot (works on files only)'''
+        if not self.old_log_path.exists():
+            return
+        try:
+            data = self.read(self.path)
+        except FileNotFoundError:
+            data = {}
+        replay_log(data, self.old_log_path)
+        write_json_atomic(self.path, data)
+        self.old_log_path.unlink()
+
+    async def close(self):
+        '''Flush pending changes and leave a compacted snapshot behind'''
+        if self._log is None:
+            # Was not loaded, nothing has changed
+            return
+        self.write()
+        with self._lock:
+            if self._compaction is not None:
+                self._compaction.join()
+            self._log.close()
+            if self.log_path.exists():
+                os.replace(self.log_path, self.old_log_path)
+            self.compact()
+            self._log = self.log_path.open('a', encoding='utf8')
+            self._log_lines = 0
+        self.data.clear()
+
+
+class AtomicJSONStorage(LocalStorageMixin, JSONStorage):
+    '''JSONStorage with collect()/commit() split (see FlushScheduler) and
+    atomic file replacement, so a crash never leaves a truncated file
+    '''
+
+    def write(self, path=None):
+        self.commit(self.collect())
+
+    def collect(self):
+        '''Serialize the whole storage (has to be done on the event loop)'''
+        return json.dumps(self.data, ensure_ascii=False)
+
+    def commit(self, text):
+        write_text_atomic(self.path, text)
+
+
+class FlushScheduler:
+    '''Coalesce storage writes requested by handlers
+
+    Handlers call mark_dirty() instead of storage.write(), the actual write
+    depends on mode:
+    - 'always'   - every call waits for the write (nothing is lost on crash);
+    - 'interval' - at most one write per interval seconds or as soon as
+                   batch_size calls have accumulated (up to interval seconds
+                   of changes may be lost on crash);
+    - 'exit'     - write only in close() (everything since start may be lost).
+
+    Serialization of changed data (storage.collect()) happens on the event
+    loop, disk I/O (storage.commit()) happens in the default thread executor
+    Anything with collect()/commit() may be flushed this way (e.g. ResultLog),
+    write time and size are recorded to write_seconds and write_chars metrics
+    If commit() fails, the error is logged and the changes are written by the
+    next flush (storage.rollback(payload), if there is one, takes back what
+    collect() has taken)
+    '''
+    modes = ('always', 'interval', 'exit')
+
+    def __init__(self, storage, mode: str = 'interval', interval: float = 1.0, batch_size: int = 100,
+                 write_seconds=STORAGE_WRITE_SECONDS, write_chars=STORAGE_WRITE_CHARS):
+        assert mode in self.modes, f'Flush mode should be one of {self.modes}, not {mode}'
+        self.storage = storage
+        self.write_seconds = write_seconds
+        self.write_chars = write_chars
+        self.mode = mode
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = 0
+        self._lock = asyncio.Lock()
+        self._timer = None
+
+    async def mark_dirty(self):
+        '''Tell the scheduler that storage has changed'''
+        self.pending += 1
+        if self.mode == 'always':
+            await self.flush()
+        elif self.mode == 'interval':
+            if self.pending >= self.batch_size:
+                asyncio.ensure_future(self.flush())
+            elif self._timer is None:
+                self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        '''Write all pending changes now'''
+        async with self._lock:
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, 0
+            started = time.perf_counter()
+            payload = self.storage.collect()
+            if payload is None:
+                # Nothing to write (e.g. the storage writes immediately)
+                return
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, self.storage.commit, payload)
+            except Exception as e:
+                print(f'Oops, flush of {type(self.storage).__name__} failed, will retry: {e!r}')
+                self.pending += pending
+                rollback = getattr(self.storage, 'rollback', None)
+                if rollback is not None:
+                    rollback(payload)
+                if self.mode == 'interval' and self._timer is None:
+                    self._timer = asyncio.ensure_future(self._flush_later())
+                return
+            self.write_seconds.observe(value=time.perf_counter() - started)
+            # payload is either a string or a list of strings
+            self.write_chars.inc(amount=sum(map(len, payload)) if isinstance(payload, list) else len(payload))
+
+    async def close(self):
+        '''Final flush, call on shutdown'''
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.pending += 1
+        await self.flush()
+
+
+class RedisStorage(BaseStorage):
+    '''FSM storage on a Redis-protocol server (Redis, Valkey, KeyDB, etc),
+    so that several bot processes can serve the same users
+    Requires the redis package (pip install redis)
+
+    Every user is stored as a JSON string {'state', 'data', 'bucket'} under
+    '{prefix}:fsm:{chat}:{user}', locks are kept under '{prefix}:lock:{chat}'
+    Changes are written immediately, so collect() has nothing to flush
+    '''
+
+    def __init__(self, url: str = 'redis://localhost:6379/0', prefix: str = 'quiz-bot',
+                 lock_timeout: float = 60, client=None):
+        if client is None:
+            from redis.asyncio import Redis
+            client = Redis.from_url(url)
+        self.redis = client
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+        self._subscriptions = []
+
+    def key(self, chat, user) -> str:
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        return f'{self.prefix}:fsm:{chat}:{user}'
+
+    async def get_record(self, *, chat=None, user=None) -> dict:
+        raw = await self.redis.get(self.key(chat, user))
+        if raw is None:
+            return {'state': None, 'data': {}, 'bucket': {}}
+        return json.loads(raw)
+
+    async def set_record(self, record: dict, *, chat=None, user=None):
+        if record == {'state': None, 'data': {}, 'bucket': {}}:
+            await self.redis.delete(self.key(chat, user))
+        else:
+            await self.redis.set(self.key(chat, user), json.dumps(record, ensure_ascii=False))
+
+    async def get_state(self, *, chat=None, user=None, default=None) -> typing.Optional[str]:
+        record = await self.get_record(chat=chat, user=user)
+        return record['state'] or self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None) -> typing.Dict:
+        record = await self.get_record(chat=chat, user=user)
+        return record['data'] or default or {}
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        record = await self.get_record(chat=chat, user=user)
+        record['state'] = self.resolve_state(state)
+        await self.set_record(record, chat=chat, user=user)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        record = await self.get_record(chat=chat, user=user)
+        record['data'] = data or {}
+        await self.set_record(record, chat=chat, user=user)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        record = await self.get_record(chat=chat, user=user)
+        record['data'].update(data or {}, **kwargs)
+        await self.set_record(record, chat=chat, user=user)
+
+    async def remove(self, *, chat=None, user=None):
+        '''Forget the user's record altogether'''
+        await self.redis.delete(self.key(chat, user))
+
+    def load(self):
+        '''Nothing to load, the data stays on the server'''
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None) -> typing.Dict:
+        record = await self.get_record(chat=chat, user=user)
+        return record['bucket'] or default or {}
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        record = await self.get_record(chat=chat, user=user)
+        record['bucket'] = bucket or {}
+        await self.set_record(record, chat=chat, user=user)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        record = await self.get_record(chat=chat, user=user)
+        record['bucket'].update(bucket or {}, **kwargs)
+        await self.set_record(record, chat=chat, user=user)
+
+    def lock(self, chat):
+        '''Return a lock serializing updates of the chat across processes
+        (expires after lock_timeout seconds if the holder dies)
+        '''
+        return self.redis.lock(
+            f'{self.prefix}:lock:{chat}',
+            timeout=self.lock_timeout,
+            blocking_timeout=self.lock_timeout,
+            sleep=0.01,
+        )
+
+    async def records(self, batch_size: int = 500):
+        '''Yield (chat, user, {'state', 'data', 'bucket'}) for every user'''
+        keys = []
+        async for key in self.redis.scan_iter(match=f'{self.prefix}:fsm:*', count=batch_size):
+            keys.append(key)
+            if len(keys) >= batch_size:
+                async for item in self._records(keys):
+                    yield item
+                keys = []
+        async for item in self._records(keys):
+            yield item
+
+    async def _records(self, keys):
+        if not keys:
+            return
+        for key, raw in zip(keys, await self.redis.mget(keys)):
+            if raw is not None:
+                key = key.decode() if isinstance(key, bytes) else key
+                chat, user = key.rsplit(':', 2)[1:]
+                yield chat, user, json.loads(raw)
+
+    async def publish(self, channel: str, message: str):
+        '''Tell other bot processes about something (e.g. quizes reload)'''
+        await self.redis.publish(f'{self.prefix}:{channel}', message)
+
+    def subscribe(self, channel: str, callback):
+        '''Await callback(message) for every message published to channel'''
+        task = asyncio.ensure_future(self._listen(f'{self.prefix}:{channel}', callback))
+        self._subscriptions.append(task)
+
+    async def _listen(self, channel: str, callback):
+        async with self.redis.pubsub() as pubsub:
+            await pubsub.subscribe(channel)
+            async for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+                data = message['data']
+                try:
+                    await callback(data.decode() if isinstance(data, bytes) else data)
+                except Exception as e:
+                    print(f'Oops, {channel} callback failed: {e!r}')
+
+    def write(self, path=None):
+        pass
+
+    def collect(self):
+        return None
+
+    def commit(self, payload):
+        pass
+
+    async def close(self):
+        for task in self._subscriptions:
+            task.cancel()
+        await self.redis.aclose()
+
+    async def wait_closed(self):
+        pass
+
+
+def replay_log(data: dict, log_path: pathlib.Path, truncate: bool = False) -> int:
+    '''Apply log records to data in place, return the number of records
+    A torn last line (crash in the middle of a write) is ignored, with
+    truncate it is also cut off the file
+    '''
+    count = 0
+    valid = 0
+    try:
+        file = log_path.open('rb')
+    except FileNotFoundError:
+        return count
+    with file:
+        for line in file:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if record['value']:
+                data[record['chat']] = record['value']
+            else:
+                data.pop(record['chat'], None)
+            count += 1
+            valid += len(line)
+    if truncate and valid < log_path.stat().st_size:
+        print(f'Oops, dropping torn end of {log_path} after {count} records')
+        with log_path.open('r+b') as file:
+            file.truncate(valid)
+    return count
+
+
+def write_json_atomic(path: pathlib.Path, data):
+    '''Write data to a temporary file and move it over path'''
+    write_text_atomic(path, json.dumps(data, ensure_ascii=False))
+
+
+def write_text_atomic(path: pathlib.Path, text: str):
+    '''Write text to a temporary file, make sure it is on disk and move it
+    over path, so a crash leaves either the old or the new file
+    '''
+    tmp_path = pathlib.Path(f'{path}.tmp')
+    with tmp_path.open('w', encoding='utf8') as file:
+        file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
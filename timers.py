@@ -0,0 +1,81 @@
+import asyncio
+import heapq
+import time
+
+
+class DeadlineScheduler:
+    '''Call callback(key, deadline) coroutine once the wall clock reaches
+    the deadline (a time.time() timestamp, so it may be saved and restored
+    after restart) of the key
+
+    All the deadlines are kept in a single heap served by one task, however
+    many keys there are. A key has at most one deadline: scheduling it again
+    replaces the deadline, cancel() forgets it. Replaced and cancelled
+    entries are not searched for in the heap, they are skipped when they
+    come up (or dropped by compact() if they pile up)
+    '''
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.deadlines = {}
+        self._heap = []
+        self._wakeup = None
+        self._worker = None
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, deadline: float):
+        if self._worker is None:
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.ensure_future(self._run())
+        self.deadlines[key] = deadline
+        if not self._heap or deadline < self._heap[0][0]:
+            # The worker sleeps until the earliest deadline it knows about
+            self._wakeup.set()
+        heapq.heappush(self._heap, (deadline, str(key), key))
+        if len(self._heap) > 2 * len(self.deadlines) + 1000:
+            self.compact()
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    def compact(self):
+        '''Drop replaced and cancelled entries from the heap'''
+        self._heap = [(deadline, str(key), key) for key, deadline in self.deadlines.items()]
+        heapq.heapify(self._heap)
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, key = heapq.heappop(self._heap)
+                if self.deadlines.get(key) != deadline:
+                    continue
+                del self.deadlines[key]
+                task = asyncio.ensure_future(self._expire(key, deadline))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            self._wakeup.clear()
+            wait = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _expire(self, key, deadline: float):
+        try:
+            await self.callback(key, deadline)
+        except Exception as e:
+            print(f'Oops, deadline of {key} was not processed: {e!r}')
+
+    async def close(self):
+        '''Stop firing (deadlines are restored from storage on startup) and
+        wait for callbacks in progress, call on shutdown
+        '''
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,79 @@
+import hmac
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.webhook import BOT_DISPATCHER_KEY, WebhookRequestHandler
+
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class SecretWebhookHandler(WebhookRequestHandler):
+    '''Process an update only if it comes with the right secret token
+    (Telegram sends the one given to setWebhook in SECRET_HEADER)
+    '''
+
+    async def post(self):
+        secret = self.request.app['webhook_secret']
+        if secret and not hmac.compare_digest(self.request.headers.get(SECRET_HEADER, ''), secret):
+            raise web.HTTPForbidden()
+        return await super().post()
+
+
+async def health(request: web.Request):
+    '''The process is alive'''
+    return web.Response(text='ok')
+
+
+async def readiness(request: web.Request):
+    '''The process is ready to accept updates'''
+    loaded = request.app['loaded']
+    if request.app['ready'] and (loaded is None or loaded.is_set()):
+        return web.Response(text='ready')
+    return web.Response(text='not ready', status=503)
+
+
+def make_app(dp: Dispatcher, path: str, secret: str = '', url: str = None,
+             on_startup=None, on_shutdown=None, loaded=None) -> web.Application:
+    '''Return aiohttp application processing updates POSTed to path
+    and answering GET /healthz and /readyz
+
+    If url is set, the webhook is registered with Telegram on startup
+    (otherwise it is expected to be registered by other means, e.g. for
+    offline testing with synthetic updates)
+    on_startup(dp) and on_shutdown(dp) coroutines are awaited before the app
+    is marked as ready and after it is marked as not ready respectively
+    If loaded (asyncio.Event) is given, the app is not ready until it is set
+    as well (e.g. the storage is still being loaded after on_startup)
+    '''
+    app = web.Application()
+    app[BOT_DISPATCHER_KEY] = dp
+    app['_check_ip'] = False
+    app['webhook_secret'] = secret
+    app['ready'] = False
+    app['loaded'] = loaded
+    app.router.add_route('*', path, SecretWebhookHandler, name='webhook_handler')
+    app.router.add_get('/healthz', health)
+    app.router.add_get('/readyz', readiness)
+
+    async def startup(app: web.Application):
+        Dispatcher.set_current(dp)
+        Bot.set_current(dp.bot)
+        if on_startup is not None:
+            await on_startup(dp)
+        if url:
+            await dp.bot.set_webhook(url, secret_token=secret or None)
+        app['ready'] = True
+
+    async def shutdown(app: web.Application):
+        app['ready'] = False
+        if on_shutdown is not None:
+            await on_shutdown(dp)
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        session = await dp.bot.get_session()
+        await session.close()
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    return app